@@ -0,0 +1,130 @@
+import os
+import time
+import shutil
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+# Адаптивный допуск скачиваний: лимит одновременных скачиваний подстраивается
+# под нагрузку CPU, свободную память и диск (по /proc), а каждое задание
+# допускается, только если его оценка памяти влезает в то, что осталось
+MB = 1024 * 1024
+
+_state = {
+    "limit": max(config.ADMISSION_MIN_CONCURRENT, min(config.ADMISSION_MAX_CONCURRENT, config.MAX_CONCURRENT_DOWNLOADS)),
+    "cpus": os.cpu_count() or 1,
+    "load": None,           # loadavg за минуту
+    "mem_available": None,  # MemAvailable на момент замера, байт
+    "disk_free": None,
+    "reserved": 0,          # оценка памяти выполняющихся заданий, до их завершения
+    "reasons": [],
+    "updated": None,
+}
+
+
+def _read_loadavg() -> float | None:
+    try:
+        with open("/proc/loadavg") as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None  # не Linux — решаем без этого показателя
+
+
+def _read_mem_available() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _read_disk_free() -> int | None:
+    try:
+        return shutil.disk_usage(config.DOWNLOADS_DIR if os.path.isdir(config.DOWNLOADS_DIR) else ".").free
+    except OSError:
+        return None
+
+
+def update(running: int, waiting: int):
+    """
+    Перечитать показатели и сдвинуть лимит на одно задание вверх или вниз.
+    Растет лимит только при очереди и свободных ресурсах, уменьшается при нехватке любого из них.
+    """
+    load = _read_loadavg()
+    mem_available = _read_mem_available()
+    disk_free = _read_disk_free()
+    # reserved не сбрасываем: склейка ffmpeg идет в конце многоминутного задания,
+    # и свежий MemAvailable ее еще не отражает
+    _state.update(load=load, mem_available=mem_available, disk_free=disk_free, updated=time.time())
+
+    limit = _state["limit"]
+    if not config.ADAPTIVE_ADMISSION:
+        _state["limit"] = config.MAX_CONCURRENT_DOWNLOADS
+        _state["reasons"] = ["адаптация выключена"]
+        return
+
+    per_cpu = load / _state["cpus"] if load is not None else None
+    reasons = []
+    if per_cpu is not None and per_cpu > config.ADMISSION_HIGH_LOAD:
+        reasons.append(f"нагрузка {per_cpu:.2f} на ядро выше {config.ADMISSION_HIGH_LOAD}")
+    if mem_available is not None and mem_available < config.ADMISSION_MEM_RESERVE:
+        reasons.append(f"свободной памяти {mem_available // MB} МБ меньше резерва {config.ADMISSION_MEM_RESERVE // MB} МБ")
+    if disk_free is not None and disk_free < config.MIN_FREE_DISK:
+        reasons.append(f"на диске {disk_free // MB} МБ, меньше {config.MIN_FREE_DISK // MB} МБ")
+
+    if reasons:
+        limit -= 1
+    elif waiting and running >= limit:
+        calm = per_cpu is None or per_cpu < config.ADMISSION_LOW_LOAD
+        roomy = mem_available is None or mem_available > 2 * config.ADMISSION_MEM_RESERVE
+        if calm and roomy:
+            limit += 1
+            reasons.append("есть очередь, CPU и памяти хватает")
+        else:
+            reasons.append("есть очередь, но запаса CPU или памяти нет")
+    else:
+        reasons.append("в норме")
+
+    limit = max(config.ADMISSION_MIN_CONCURRENT, min(config.ADMISSION_MAX_CONCURRENT, limit))
+    if limit != _state["limit"]:
+        logger.info(f"Лимит скачиваний: {_state['limit']} -> {limit} ({'; '.join(reasons)})")
+    _state["limit"] = limit
+    _state["reasons"] = reasons
+
+
+def get_limit() -> int:
+    return _state["limit"] if config.ADAPTIVE_ADMISSION else config.MAX_CONCURRENT_DOWNLOADS
+
+
+def fits(cost: int, running: int) -> bool:
+    """Хватит ли памяти еще на одно задание с оценкой cost (одно задание допускается всегда)"""
+    if not config.ADAPTIVE_ADMISSION or running == 0 or _state["mem_available"] is None:
+        return True
+    return cost <= _state["mem_available"] - config.ADMISSION_MEM_RESERVE - _state["reserved"]
+
+
+def reserve(cost: int):
+    """
+    Задание начато: его оценка держится до release. Память самого yt-dlp замер
+    со временем учтет дважды — лучше так, чем пропустить вторую склейку.
+    """
+    _state["reserved"] += cost
+
+
+def release(cost: int):
+    """Задание закончилось: его оценка больше не нужна"""
+    _state["reserved"] = max(0, _state["reserved"] - cost)
+
+
+def get_stats() -> dict:
+    return {
+        **_state,
+        "limit": get_limit(),
+        "adaptive": config.ADAPTIVE_ADMISSION,
+        "min": config.ADMISSION_MIN_CONCURRENT,
+        "max": config.ADMISSION_MAX_CONCURRENT,
+    }
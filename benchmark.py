@@ -0,0 +1,521 @@
+"""
+Офлайн-нагрузочный тест бота: без Telegram и без реальных сайтов.
+
+- FakeBot вместо context.bot: записывает вызовы Bot API и имитирует их задержку
+  (по желанию — через настоящий ratelimit.TelegramRateLimiter);
+- FakeYoutubeDL вместо yt_dlp.YoutubeDL: метаданные отдает сразу, а файл
+  качает с локального HTTP-сервера с синтетическими данными на заданной скорости;
+- драйвер прогоняет N пользователей через start -> handle_message -> button.
+
+Отдельно — микробенчмарк разбора ссылок (команда urls).
+
+Пример: python benchmark.py load --users 50 --videos 10 --media-rate 20
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import timeit
+import tempfile
+import threading
+import itertools
+import urllib.request
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Состояние бота пишем во временную папку, а не рядом с рабочей базой
+_workdir = tempfile.mkdtemp(prefix="bench_")
+os.environ["STORAGE_PATH"] = os.path.join(_workdir, "state.db")
+
+import config
+import utils
+import bot
+import storage
+import progress
+import metrics
+import ratelimit
+
+# bot.py включает INFO-логи; в отчете они только мешают
+logging.getLogger().setLevel(logging.WARNING)
+
+MB = 1024 * 1024
+# Битрейт синтетических форматов, бит/с
+_BITRATES = {360: 700_000, 480: 1_200_000, 720: 2_500_000, 1080: 5_000_000}
+
+
+# --- синтетические медиа ---
+class _MediaHandler(BaseHTTPRequestHandler):
+    """GET /media/<id>?size=N — N байт со скоростью rate байт/с на соединение"""
+    rate = 20 * MB
+
+    def do_GET(self):
+        size = int(parse_qs(urlparse(self.path).query)["size"][0])
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = b"\0" * 65536
+        sent = 0
+        started = time.monotonic()
+        try:
+            while sent < size:
+                n = min(len(chunk), size - sent)
+                self.wfile.write(chunk[:n])
+                sent += n
+                ahead = sent / self.rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def start_media_server(rate: float) -> tuple:
+    _MediaHandler.rate = rate
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _MediaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class FakeYoutubeDL:
+    """Замена yt_dlp.YoutubeDL с тем же подмножеством API, что использует utils"""
+    media_url = None
+    duration = 30
+
+    def __init__(self, params: dict = None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True, ie_key: str = None) -> dict:
+        match = re.search(r"[?&]v=([\w-]+)", url)
+        video_id = match.group(1) if match else str(abs(hash(url)))
+        formats = [
+            {
+                "format_id": str(height),
+                "height": height,
+                "ext": "mp4",
+                "vcodec": "avc1",
+                "acodec": "mp4a",
+                "tbr": bitrate / 1000,
+                "filesize": bitrate // 8 * self.duration,
+            }
+            for height, bitrate in _BITRATES.items()
+        ]
+        info = {
+            "id": video_id,
+            "title": f"bench {video_id}",
+            "extractor_key": "Youtube",
+            "webpage_url": url,
+            "duration": self.duration,
+            "formats": formats,
+        }
+        return self.process_ie_result(info, download=True) if download else info
+
+    def sanitize_info(self, info: dict) -> dict:
+        return info
+
+    def _pick_format(self, info: dict) -> dict:
+        first = self.params.get("format", "").split("/")[0]
+        by_id = {fmt["format_id"]: fmt for fmt in info["formats"]}
+        if first.split("+")[0] in by_id:
+            return by_id[first.split("+")[0]]
+        match = re.search(r"height<=(\d+)", self.params.get("format", ""))
+        limit = int(match.group(1)) if match else max(_BITRATES)
+        return max((fmt for fmt in info["formats"] if fmt["height"] <= limit), key=lambda f: f["height"])
+
+    def process_ie_result(self, info: dict, download: bool = True) -> dict:
+        fmt = self._pick_format(info)
+        info = dict(info, height=fmt["height"], ext=fmt["ext"], format_id=fmt["format_id"])
+        if not download:
+            return info
+        size = fmt["filesize"]
+        path = self.prepare_filename(info)
+        hooks = self.params.get("progress_hooks") or []
+        started = time.monotonic()
+        downloaded = 0
+        with urllib.request.urlopen(f"{self.media_url}/media/{info['id']}?size={size}") as response, open(path, "wb") as f:
+            while True:
+                data = response.read(256 * 1024)
+                if not data:
+                    break
+                f.write(data)
+                downloaded += len(data)
+                elapsed = max(time.monotonic() - started, 1e-6)
+                speed = downloaded / elapsed
+                for hook in hooks:
+                    hook({
+                        "status": "downloading",
+                        "downloaded_bytes": downloaded,
+                        "total_bytes": size,
+                        "speed": speed,
+                        "eta": (size - downloaded) / speed,
+                    })
+        for hook in hooks:
+            hook({"status": "finished", "filename": path})
+        return info
+
+    def prepare_filename(self, info: dict) -> str:
+        return self.params["outtmpl"] % info
+
+
+# --- Bot API ---
+class FakeBot:
+    """Вместо context.bot: считает вызовы и имитирует задержку Bot API"""
+
+    def __init__(self, latency: float, jitter: float, upload_rate: float, limiter=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.upload_rate = upload_rate
+        self.limiter = limiter
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+        self._messages = {}  # {message_id: FakeMessage} — для правок по chat_id/message_id
+
+    async def call(self, endpoint: str, chat_id=None, rate_limit_args=None, extra_delay: float = 0, result=None):
+        async def request():
+            self.calls[endpoint] += 1
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter) + extra_delay)
+            return result
+
+        if self.limiter is None:
+            return await request()
+        return await self.limiter.process_request(
+            request, (), {}, endpoint, {"chat_id": chat_id} if chat_id else {}, rate_limit_args
+        )
+
+    # Сигнатуры повторяют PTB 20.3 (ExtBot): лишний аргумент должен падать так же, как в боевом боте
+    async def get_chat_member(self, chat_id, user_id, *, read_timeout=None, write_timeout=None,
+                              connect_timeout=None, pool_timeout=None, api_kwargs=None, rate_limit_args=None):
+        return await self.call("getChatMember", chat_id, rate_limit_args, result=SimpleNamespace(status="member"))
+
+    async def edit_message_text(self, text: str, chat_id=None, message_id: int = None, inline_message_id: str = None,
+                                parse_mode=None, disable_web_page_preview=None, reply_markup=None, entities=None, *,
+                                read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None,
+                                api_kwargs=None, rate_limit_args=None):
+        await self.call("editMessageText", chat_id, rate_limit_args)
+        message = self._messages[message_id]
+        message.text = text
+        message.reply_markup = reply_markup
+        return message
+
+    def new_message(self, chat_id: int, text: str = None):
+        message = FakeMessage(self, chat_id, next(self._ids), text)
+        self._messages[message.message_id] = message
+        return message
+
+
+class FakeMessage:
+    def __init__(self, fake_bot: FakeBot, chat_id: int, message_id: int, text: str = None):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.reply_markup = None
+        self.replies = []
+
+    # Сокращения Message/CallbackQuery в PTB 20.3 не принимают rate_limit_args
+    async def reply_text(self, text: str, parse_mode=None, disable_web_page_preview=None, disable_notification=None,
+                         protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None,
+                         reply_markup=None, entities=None, message_thread_id=None, quote=None, *,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None,
+                         api_kwargs=None):
+        await self.bot.call("sendMessage", self.chat_id)
+        message = self.bot.new_message(self.chat_id, text)
+        message.reply_markup = reply_markup
+        self.replies.append(message)
+        return message
+
+    async def edit_text(self, text: str, parse_mode=None, disable_web_page_preview=None, reply_markup=None,
+                        entities=None, *, read_timeout=None, write_timeout=None, connect_timeout=None,
+                        pool_timeout=None, api_kwargs=None):
+        await self.bot.call("editMessageText", self.chat_id)
+        self.text = text
+        self.reply_markup = reply_markup
+        return self
+
+    async def reply_video(self, video, duration=None, caption: str = None, disable_notification=None,
+                          reply_to_message_id=None, reply_markup=None, parse_mode=None, supports_streaming=None,
+                          width=None, height=None, allow_sending_without_reply=None, caption_entities=None,
+                          filename=None, quote=None, protect_content=None, message_thread_id=None,
+                          has_spoiler=None, thumbnail=None, *, read_timeout=None, write_timeout=20,
+                          connect_timeout=None, pool_timeout=None, api_kwargs=None):
+        # Файл "загружается" со скоростью upload_rate, повтор по file_id — мгновенно
+        delay = os.fstat(video.fileno()).st_size / self.bot.upload_rate if hasattr(video, "fileno") else 0
+        await self.bot.call("sendVideo", self.chat_id, extra_delay=delay)
+        file_id = video if isinstance(video, str) else f"bench-file-{next(self.bot._ids)}"
+        return SimpleNamespace(video=SimpleNamespace(file_id=file_id), document=None)
+
+
+class FakeCallbackQuery:
+    def __init__(self, user, message: FakeMessage, data: str):
+        self.from_user = user
+        self.message = message
+        self.data = data
+
+    async def answer(self, text: str = None, show_alert: bool = None, url: str = None, cache_time: int = None, *,
+                     read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None,
+                     api_kwargs=None):
+        await self.message.bot.call("answerCallbackQuery")
+
+    async def edit_message_text(self, text: str, parse_mode=None, disable_web_page_preview=None, reply_markup=None,
+                                entities=None, *, read_timeout=None, write_timeout=None, connect_timeout=None,
+                                pool_timeout=None, api_kwargs=None):
+        return await self.message.edit_text(text, parse_mode, disable_web_page_preview, reply_markup, entities)
+
+
+class FakeApplication:
+    """context.application: фоновые задачи обработчиков с замером времени"""
+
+    def __init__(self, timings: dict):
+        self.timings = timings
+        self.tasks = {}  # {id(update): task}
+
+    def create_task(self, coroutine, update=None):
+        task = asyncio.create_task(_timed(self.timings, "quality_keyboard", coroutine))
+        self.tasks[id(update)] = task
+        return task
+
+
+# --- драйвер ---
+async def _timed(timings: dict, name: str, coroutine):
+    started = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        timings.setdefault(name, []).append(time.perf_counter() - started)
+
+
+def _update(user, message=None, callback_query=None):
+    return SimpleNamespace(effective_user=user, message=message, callback_query=callback_query)
+
+
+async def run_user(n: int, args, fake_bot: FakeBot, app: FakeApplication, timings: dict, outcomes: Counter):
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    user = SimpleNamespace(id=1_000_000 + n)
+    context = SimpleNamespace(bot=fake_bot, application=app, args=[])
+
+    await _timed(timings, "start", bot.start(_update(user, fake_bot.new_message(user.id, "/start")), context))
+
+    url = f"https://www.youtube.com/watch?v=bench{n % args.videos:06d}"
+    message = fake_bot.new_message(user.id, url)
+    update = _update(user, message)
+    await _timed(timings, "handle_message", bot.handle_message(update, context))
+    task = app.tasks.pop(id(update), None)
+    if task is None:
+        outcomes["нет клавиатуры"] += 1
+        return
+    await task
+
+    # Пользователь думает над выбором качества — в это время может идти предзагрузка
+    await asyncio.sleep(random.uniform(0, args.think))
+    keyboard_message = message.replies[-1]
+    markup = keyboard_message.reply_markup
+    buttons = [button for row in markup.inline_keyboard for button in row] if markup else []
+    if not buttons:
+        outcomes["нет клавиатуры"] += 1
+        return
+    wanted = [b for b in buttons if b.callback_data.startswith(f"quality_{args.quality}_")]
+    query = FakeCallbackQuery(user, keyboard_message, (wanted or buttons)[0].callback_data)
+    await _timed(timings, "button", bot.button(_update(user, callback_query=query), context))
+
+    outcomes["доставлено" if keyboard_message.text.startswith("✅") else keyboard_message.text.split("\n")[0]] += 1
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def run_load(args) -> dict:
+    server, FakeYoutubeDL.media_url = start_media_server(args.media_rate * MB)
+    FakeYoutubeDL.duration = args.duration
+    utils.yt_dlp = SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+
+    config.DOWNLOADS_DIR = os.path.join(_workdir, "downloads")
+    config.CHANNELS = ["@bench"]
+    config.MAX_DAILY_DOWNLOADS = 10 ** 6
+    config.ENABLE_TRANSCODE = False
+    config.DOWNLOAD_BACKEND = "local"
+    config.DOWNLOAD_POOL_TYPE = "thread"  # подмена экстрактора видна только в этом процессе
+    config.ENABLE_PREFETCH = args.prefetch
+    if args.slots:
+        # Фиксированный лимит: адаптивный допуск подстроил бы его под эту машину
+        config.ADAPTIVE_ADMISSION = False
+        config.MAX_CONCURRENT_DOWNLOADS = args.slots
+        config.DOWNLOAD_WORKERS = max(config.DOWNLOAD_WORKERS, args.slots)
+    utils.load_state()
+    if args.prefetch:
+        # История выборов, чтобы предзагрузка знала вероятное качество
+        for _ in range(config.PREFETCH_MIN_CHOICES):
+            utils.track_quality_choice("https://www.youtube.com/watch?v=seed0000000", args.quality)
+
+    limiter = ratelimit.TelegramRateLimiter() if args.rate_limit else None
+    fake_bot = FakeBot(args.api_latency, args.api_jitter, args.upload_rate * MB, limiter)
+    timings = {}
+    outcomes = Counter()
+    app = FakeApplication(timings)
+
+    progress.start()
+    metrics.start()
+    utils.start_admission()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[
+            run_user(n, args, fake_bot, app, timings, outcomes) for n in range(args.users)
+        ])
+    finally:
+        elapsed = time.perf_counter() - started
+        progress.stop()
+        metrics.stop()
+        utils.stop_admission()
+        utils.shutdown_download_executor()
+        storage.close()
+        server.shutdown()
+
+    return {
+        "users": args.users,
+        "elapsed": elapsed,
+        "handlers": {
+            name: {
+                "count": len(values),
+                "p50_ms": _percentile(values, 0.5) * 1000,
+                "p99_ms": _percentile(values, 0.99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+            for name, values in timings.items()
+        },
+        "outcomes": dict(outcomes),
+        "downloads_per_minute": outcomes["доставлено"] / elapsed * 60,
+        # ru_maxrss в Linux — в килобайтах
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "api_calls": dict(fake_bot.calls),
+        "stages": metrics.get_stage_summary(),
+        "prefetch": utils.get_prefetch_stats(),
+        "loop_lag_max_ms": metrics.get_loop_lag()["max"] * 1000,
+    }
+
+
+def print_load_report(report: dict):
+    print(f"Пользователей: {report['users']}, время: {report['elapsed']:.1f} сек")
+    print(f"Доставлено в минуту: {report['downloads_per_minute']:.1f}, пик RSS: {report['peak_rss_mb']:.0f} МБ, "
+          f"макс. задержка event loop: {report['loop_lag_max_ms']:.0f} мс")
+    print("\nОбработчики (p50 / p99 / max, мс):")
+    for name, h in report["handlers"].items():
+        print(f"  {name:<18} {h['p50_ms']:>9.1f} {h['p99_ms']:>9.1f} {h['max_ms']:>9.1f}  ({h['count']})")
+    print("\nЭтапы (среднее / p95, сек):")
+    for stage, s in report["stages"].items():
+        print(f"  {stage:<18} {s['avg']:>9.2f} {s['p95']:>9g}  ({s['count']})")
+    print("\nИсходы:")
+    for outcome, count in sorted(report["outcomes"].items(), key=lambda kv: -kv[1]):
+        print(f"  {count:>5}  {outcome}")
+    if report["prefetch"]["started"]:
+        print("\nПредзагрузка: " + ", ".join(f"{k}: {v}" for k, v in report["prefetch"].items()))
+    print("\nВызовы Bot API:")
+    for endpoint, count in sorted(report["api_calls"].items()):
+        print(f"  {count:>5}  {endpoint}")
+
+
+# --- разбор ссылок ---
+SAMPLE_URLS = (
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=10",
+    "https://m.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://youtube.com/shorts/dQw4w9WgXcQ",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ",
+    "https://www.tiktok.com/@user.name/video/7234567890123456789?lang=ru",
+    "https://vm.tiktok.com/ZMabcdef/",
+    "https://www.instagram.com/reel/Cabc123-_x/?igsh=1",
+    "https://www.instagram.com/p/Cabc123-_x/",
+    "https://www.instagram.com/explore/tags/p/",
+    "https://vk.com/video-12345_67890",
+    "https://vk.com/feed?z=video-12345_67890%2Fabc",
+    "https://vimeo.com/123456789",
+    "https://player.vimeo.com/video/123456789",
+    "https://www.dailymotion.com/video/x8abcde",
+    "https://example.com/watch?v=dQw4w9WgXcQ",
+)
+
+
+def run_urls(args):
+    print("Разбор ссылок:")
+    for url in SAMPLE_URLS:
+        print(f"  {url}\n    -> {utils.parse_video_url(url)}, ie_key={utils.get_ie_key(url)}")
+
+    print(f"\nВремя на ссылку ({args.number} повторов):")
+    for url in SAMPLE_URLS:
+        seconds = timeit.timeit(lambda: utils.normalize_video_url(url), number=args.number)
+        print(f"  {seconds / args.number * 1e6:>8.2f} мкс  {url}")
+
+    # Для сравнения: поиск экстрактора перебором, как делает yt-dlp без ie_key
+    try:
+        from yt_dlp.extractor import gen_extractor_classes
+    except ImportError:
+        print("\nyt-dlp не установлен — сравнение с перебором экстракторов пропущено")
+        return
+    extractors = list(gen_extractor_classes())
+    number = max(1, args.number // 100)
+    print(f"\nПеребор {len(extractors)} экстракторов yt-dlp ({number} повторов):")
+    for url in SAMPLE_URLS:
+        seconds = timeit.timeit(lambda: next(ie for ie in extractors if ie.suitable(url)), number=number)
+        print(f"  {seconds / number * 1e6:>8.2f} мкс  {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load", help="прогнать N пользователей через обработчики")
+    load.add_argument("--users", type=int, default=20)
+    load.add_argument("--videos", type=int, default=0, help="разных видео (0 — у каждого свое)")
+    load.add_argument("--quality", default="720")
+    load.add_argument("--duration", type=int, default=30, help="длительность синтетического видео, сек")
+    load.add_argument("--media-rate", type=float, default=20, help="скорость сервера медиа, МБ/с на соединение")
+    load.add_argument("--upload-rate", type=float, default=50, help="скорость загрузки в Telegram, МБ/с")
+    load.add_argument("--api-latency", type=float, default=0.05, help="задержка Bot API, сек")
+    load.add_argument("--api-jitter", type=float, default=0.02)
+    load.add_argument("--ramp", type=float, default=1.0, help="за сколько секунд приходят все пользователи")
+    load.add_argument("--think", type=float, default=0, help="сколько пользователь выбирает качество (до), сек")
+    load.add_argument("--prefetch", action="store_true", help="включить предзагрузку вероятного качества")
+    load.add_argument("--slots", type=int, default=0, help="фиксированный MAX_CONCURRENT_DOWNLOADS (0 — адаптивный допуск из config)")
+    load.add_argument("--rate-limit", action="store_true", help="пропускать вызовы через TelegramRateLimiter")
+    load.add_argument("--json", action="store_true", help="вывести результат в JSON")
+
+    urls = commands.add_parser("urls", help="микробенчмарк разбора ссылок")
+    urls.add_argument("--number", type=int, default=10000, help="повторов на ссылку")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "load":
+            args.videos = args.videos or args.users
+            report = asyncio.run(run_load(args))
+            if args.json:
+                json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+                print()
+            else:
+                print_load_report(report)
+        elif args.command == "urls":
+            run_urls(args)
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
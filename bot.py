@@ -1,11 +1,14 @@
 import os
+import time
 import logging
 from telegram import Update
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ContextTypes, filters
+    CallbackQueryHandler, ChatMemberHandler, ContextTypes, filters
 )
-import utils, config
+import utils, config, storage, progress, ratelimit, httpserver, jobqueue, metrics, admission, profiling
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -58,7 +61,7 @@ async def analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message += f"📅 **За последние дни:**\n"
         sorted_days = sorted(daily_stats.items(), reverse=True)[:7]
         for date, count in sorted_days:
-            message += f"• {date}: {count} скачиваний\n"
+            message += f"• {date}: {count} скачиваний, {stats['daily_active'].get(date, 0)} активных\n"
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
@@ -77,16 +80,192 @@ async def system(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = f"🖥️ **Состояние системы**\n\n"
     message += f"📊 **Нагрузка:**\n"
     message += f"• Активных скачиваний: {load_info['active_downloads']}/{load_info['max_concurrent']}\n"
-    message += f"• Загрузка: {load_info['load_percentage']:.1f}%\n\n"
+    message += f"• Загрузка: {load_info['load_percentage']:.1f}%\n"
+    message += f"• В очереди: {load_info['queue_depth']}/{load_info['max_queue']}\n"
+    message += f"• Дольше всех ждет: {load_info['longest_wait']:.0f} сек\n"
+    message += f"• Среднее ожидание: {load_info['avg_wait']:.0f} сек\n"
+    message += f"• Среднее скачивание: {load_info['avg_duration']:.0f} сек\n"
+    lag = metrics.get_loop_lag()
+    message += f"• Задержка event loop: {lag['last'] * 1000:.0f} мс (максимум {lag['max'] * 1000:.0f} мс)\n\n"
+
+    stages = metrics.get_stage_summary()
+    if stages:
+        message += f"⏱ **Этапы (среднее / p50 / p95, сек):**\n"
+        for stage, s in stages.items():
+            message += f"• {stage}: {s['avg']:.2f} / {s['p50']:g} / {s['p95']:g} ({s['count']})\n"
+        message += "\n"
+
+    outcomes = metrics.get_counter_totals("bot_downloads_total", "outcome")
+    if outcomes:
+        extractors = metrics.get_counter_totals("bot_downloads_total", "extractor")
+        message += f"🎯 **Запросы видео:**\n"
+        message += "• " + ", ".join(f"{k}: {v:g}" for k, v in sorted(outcomes.items())) + "\n"
+        message += "• Сайты: " + ", ".join(f"{escape_markdown(k)}: {v:g}" for k, v in sorted(extractors.items(), key=lambda kv: -kv[1])[:5]) + "\n\n"
+
+    if load_info["backend"] == "queue":
+        queue_stats = jobqueue.get_stats()
+        message += f"🏭 **Воркеры:**\n"
+        message += f"• Заняты: {queue_stats['busy_workers']}\n"
+        message += "• Задания: " + ", ".join(f"{status} {count}" for status, count in sorted(queue_stats["by_status"].items())) + "\n\n"
+    else:
+        adm = admission.get_stats()
+        mb = 1024 * 1024
+        message += f"⚖️ **Допуск:**\n"
+        if adm["adaptive"]:
+            message += f"• Лимит: {adm['limit']} (от {adm['min']} до {adm['max']})\n"
+        else:
+            message += f"• Лимит: {adm['limit']} (адаптация выключена)\n"
+        if adm["load"] is not None:
+            message += f"• Нагрузка: {adm['load']:.2f} на {adm['cpus']} ядер ({adm['load'] / adm['cpus']:.2f} на ядро)\n"
+        if adm["mem_available"] is not None:
+            message += f"• Свободно памяти: {adm['mem_available'] // mb}MB, резерв {config.ADMISSION_MEM_RESERVE // mb}MB, занято заданиями {adm['reserved'] // mb}MB\n"
+        if adm["disk_free"] is not None:
+            message += f"• Свободно на диске: {adm['disk_free'] // mb}MB\n"
+        if adm["reasons"]:
+            message += "• Причина: " + "; ".join(adm["reasons"]) + "\n"
+        message += "\n"
+
+    file_id_stats = utils.get_file_id_cache_stats()
+    message += f"📦 **Кэш file\\_id:**\n"
+    message += f"• Записей: {file_id_stats['entries']}\n"
+    message += f"• Попаданий: {file_id_stats['hits']}, промахов: {file_id_stats['misses']} ({file_id_stats['hit_rate']:.1f}%)\n\n"
     
+    disk = utils.get_disk_stats()
+    mb = 1024 * 1024
+    message += f"💾 **Диск:**\n"
+    message += f"• Временные файлы: {disk['dir_usage'] // mb}MB из {disk['quota'] // mb}MB\n"
+    message += f"• Зарезервировано под скачивания: {disk['reserved'] // mb}MB\n"
+    message += f"• Свободно на диске: {disk['free'] // mb}MB\n"
+    message += f"• Очистка: удалено файлов {disk['deleted_files']} ({disk['deleted_bytes'] // mb}MB)\n\n"
+
+    storage_stats = storage.get_stats()
+    message += f"🗄 **Хранилище:**\n"
+    message += f"• Ждут записи: {storage_stats['pending']}, записано {storage_stats['writes']} за {storage_stats['batches']} пачек\n"
+    message += f"• Ошибок записи: {storage_stats['errors']}\n\n"
+
+    prefetch_stats = utils.get_prefetch_stats()
+    if config.ENABLE_PREFETCH:
+        message += f"🔮 **Предзагрузка:**\n"
+        message += (
+            f"• Идет: {prefetch_stats['active']}, начато: {prefetch_stats['started']}, "
+            f"пригодилось: {prefetch_stats['promoted']}, отменено: {prefetch_stats['cancelled']}, "
+            f"вытеснено: {prefetch_stats['preempted']}\n\n"
+        )
+
+    attempt_stats = utils.get_download_attempt_stats()
+    if attempt_stats:
+        message += f"🔁 **Попытки скачивания:**\n"
+        message += "• " + ", ".join(f"{outcome}: {count}" for outcome, count in sorted(attempt_stats.items())) + "\n\n"
+
+    api_stats = ratelimit.get_stats()
+    message += f"📡 **Telegram API:**\n"
+    message += f"• Запросов: {api_stats['requests']}, ждали лимита: {api_stats['throttled']} (в среднем {api_stats['avg_wait']:.2f} сек)\n"
+    message += f"• RetryAfter: {api_stats['retry_after']}, отброшено правок прогресса: {api_stats['dropped']}\n\n"
+
+    message += f"🧠 **Кэши в памяти:**\n"
+    for cache_stats in utils.get_cache_stats():
+        message += (
+            f"• {escape_markdown(cache_stats['name'])}: {cache_stats['size']}/{cache_stats['maxsize']}, "
+            f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"вытеснено {cache_stats['evictions']}, истекло {cache_stats['expirations']}\n"
+        )
+    message += "\n"
+
     message += f"⚙️ **Конфигурация:**\n"
-    message += f"• Максимум одновременных скачиваний: {config.MAX_CONCURRENT_DOWNLOADS}\n"
+    message += f"• Стартовый лимит одновременных скачиваний: {config.MAX_CONCURRENT_DOWNLOADS}\n"
     message += f"• Максимальный размер файла: {config.MAX_FILE_SIZE // (1024*1024)}MB\n"
     message += f"• Лимит скачиваний в день: {config.MAX_DAILY_DOWNLOADS}\n"
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
 
+# --- /profile, /memprofile, /lag ---
+PROFILE_KINDS = {"cpu": ("CPU-профиль", "profile"), "memory": ("Профиль памяти", "memprofile")}
+
+
+async def _send_profile(bot, chat_id: int, result: dict):
+    # Без parse_mode: в именах функций и путях полно символов разметки
+    await bot.send_message(chat_id, result["text"][:4000])
+    if result["path"]:
+        try:
+            with open(result["path"], "rb") as f:
+                await bot.send_document(chat_id, f, filename=os.path.basename(result["path"]))
+        finally:
+            os.remove(result["path"])
+
+
+async def _profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str):
+    user = update.effective_user
+    if user.id != config.ADMIN_ID:
+        await update.message.reply_text("❌ Доступ запрещен. Только администратор может запускать профилирование.")
+        return
+
+    title, command = PROFILE_KINDS[kind]
+    if context.args and context.args[0] == "stop":
+        if not await profiling.finish(kind):
+            await update.message.reply_text(f"❌ {title} сейчас не снимается.")
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else config.PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text(f"❌ Использование: /{command} [секунд] или /{command} stop")
+        return
+
+    bot, chat_id = context.bot, update.effective_chat.id
+
+    async def on_done(result: dict):
+        await _send_profile(bot, chat_id, result)
+
+    try:
+        seconds = profiling.start(kind, seconds, on_done)
+    except Exception as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    await update.message.reply_text(f"⏺ {title} снимается {seconds} сек. Результат придет сюда, досрочно — /{command} stop")
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _profile_command(update, context, "cpu")
+
+
+async def memprofile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _profile_command(update, context, "memory")
+
+
+async def lag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id != config.ADMIN_ID:
+        await update.message.reply_text("❌ Доступ запрещен. Только администратор может просматривать системную информацию.")
+        return
+
+    loop_lag = metrics.get_loop_lag()
+    summary = metrics.get_histogram_summary("bot_event_loop_lag_seconds").get("")
+    message = "🐢 Задержка event loop\n"
+    message += f"• Сейчас {loop_lag['last'] * 1000:.0f} мс, максимум {loop_lag['max'] * 1000:.0f} мс\n"
+    if summary:
+        message += f"• Среднее {summary['avg'] * 1000:.0f} мс, p50 ≤ {summary['p50'] * 1000:g} мс, p95 ≤ {summary['p95'] * 1000:g} мс ({summary['count']} замеров)\n"
+
+    capture = profiling.get_capture()
+    if capture:
+        message += f"• Идет захват {capture['kind']}, осталось {capture['remaining']:.0f} сек\n"
+
+    handlers = metrics.get_histogram_summary("bot_handler_seconds", "handler")
+    if handlers:
+        message += "\n⏱ Обработчики (среднее / p95, сек):\n"
+        for name, s in sorted(handlers.items(), key=lambda kv: -kv[1]["avg"]):
+            message += f"• {name}: {s['avg']:.2f} / {s['p95']:g} ({s['count']})\n"
+
+    stalls = profiling.get_stalls()
+    message += f"\n🧱 Зависания дольше {config.SLOW_CALLBACK_THRESHOLD:g} сек: {len(stalls)}\n"
+    for stall in stalls[-5:]:
+        when = time.strftime("%H:%M:%S", time.localtime(stall["time"]))
+        message += f"\n{when} — {stall['blocked']:.2f} сек, {stall['handler'] or 'вне обработчиков'}\n"
+        message += "\n".join(stall["stack"][-3:]) + "\n"
+
+    await update.message.reply_text(message[-4000:])
+
+
 # --- /userstats ---
 async def userstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -155,9 +334,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     url = (update.message.text or "").strip()
-    norm = utils.normalize_video_url(url)
+    parsed = utils.parse_video_url(url)
+    metrics.inc("bot_links_total", site=parsed[0] if parsed else "unsupported")
 
-    if not norm:
+    if not parsed:
         await update.message.reply_text(
             "⚠️ Неверная ссылка!\n\n"
             "Поддерживаемые форматы:\n"
@@ -178,12 +358,26 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    kb, remaining = utils.quality_keyboard(norm, user.id)
-    await update.message.reply_text(
-        f"🎬 Выберите качество:\n\n"
-        f"📊 Осталось скачиваний: {remaining}/{config.MAX_DAILY_DOWNLOADS}",
-        reply_markup=kb
-    )
+    # Дальше везде используется каноническая ссылка: она же ключ кешей
+    norm = parsed[2]
+    # Отвечаем сразу, а форматы получаем в фоне
+    msg = await update.message.reply_text("🔎 Получаю доступные форматы...")
+    context.application.create_task(send_quality_keyboard(msg, norm, user.id), update=update)
+
+
+async def send_quality_keyboard(msg, url: str, user_id: int):
+    try:
+        kb, remaining = await utils.quality_keyboard_async(url, user_id)
+        await msg.edit_text(
+            f"🎬 Выберите качество:\n\n"
+            f"📊 Осталось скачиваний: {remaining}/{config.MAX_DAILY_DOWNLOADS}",
+            reply_markup=kb
+        )
+        # Пока пользователь выбирает, можно начать скачивать вероятное качество
+        utils.start_prefetch(url)
+    except Exception as e:
+        logger.error(f"Ошибка получения форматов: {e}")
+        await msg.edit_text("❌ Не удалось получить форматы видео. Попробуйте позже.")
 
 
 # --- inline кнопки ---
@@ -216,12 +410,15 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("⚠️ Ошибка: ссылка устарела")
         return
 
+    utils.cancel_other_prefetches(url, quality)
+
     if not await utils.check_subscription(query.from_user.id, context):
         await query.edit_message_text("❌ Подписка обязательна.")
         return
 
-    # Проверяем лимиты скачиваний еще раз
-    if not utils.can_user_download(query.from_user.id, config.MAX_DAILY_DOWNLOADS):
+    # Резервируем скачивание из дневного лимита; если видео не будет доставлено, слот вернется
+    user_id = query.from_user.id
+    if not utils.reserve_download(user_id, config.MAX_DAILY_DOWNLOADS):
         await query.edit_message_text(
             f"❌ Достигнут дневной лимит скачиваний!\n\n"
             f"📊 Лимит: {config.MAX_DAILY_DOWNLOADS} скачиваний в день\n"
@@ -229,59 +426,226 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    # В статистику предзагрузки идут только состоявшиеся выборы — без отказов по подписке и лимиту
+    utils.track_quality_choice(url, quality)
+
+    delivered = False
+    try:
+        delivered = await deliver_video(query, url, quality, context.bot)
+    finally:
+        if delivered:
+            utils.commit_download(user_id)
+        else:
+            utils.refund_download(user_id)
+
+    if delivered:
+        remaining = utils.get_remaining_downloads(user_id, config.MAX_DAILY_DOWNLOADS)
+        await query.edit_message_text(f"✅ Видео отправлено!\n\n📊 Осталось скачиваний: {remaining}/{config.MAX_DAILY_DOWNLOADS}")
+
+
+async def deliver_video(query, url: str, quality: str, bot) -> bool:
+    """Отправить видео пользователю; True, если оно доставлено"""
+    # Видео уже отправлялось — пересылаем по file_id без скачивания
+    media_key = utils.get_media_key(url, quality)
+    file_id = utils.get_cached_file_id(media_key)
+    extractor = utils.get_extractor(url)
+    if file_id:
+        try:
+            with metrics.timer("upload", cached="1"):
+                await query.message.reply_video(video=file_id, caption=f"📹 Видео в качестве {quality}p")
+            metrics.inc("bot_downloads_total", extractor=extractor, quality=quality, outcome="cached")
+            return True
+        except BadRequest as e:
+            # Только отказ Telegram значит, что file_id не годится; после таймаута
+            # видео могло уже уйти, и повторная отправка продублировала бы его
+            logger.warning(f"file_id {media_key} недействителен, скачиваем заново: {e}")
+            utils.forget_file_id(media_key)
+        except Exception as e:
+            logger.error(f"Не удалось отправить {media_key} по file_id: {e}")
+            metrics.inc("bot_downloads_total", extractor=extractor, quality=quality, outcome="failed")
+            await query.edit_message_text(f"❌ Ошибка отправки: {str(e)}")
+            return False
+
+    file_path = None
+    outcome = "failed"
+    # Прогресс скачивания показываем в этом же сообщении (в том числе тем, кто присоединился)
+    watch_id = f"{query.message.chat_id}:{query.message.message_id}"
+    # rate_limit_args принимают только методы бота, не сокращения вроде query.edit_message_text
+    progress.watch(
+        watch_id, utils.get_job_key(url, quality), query.message.chat_id,
+        lambda text: bot.edit_message_text(
+            text, chat_id=query.message.chat_id, message_id=query.message.message_id,
+            rate_limit_args={"priority": ratelimit.PRIORITY_LOW},
+        ),
+    )
     try:
         await query.edit_message_text(f"⏳ Скачиваю в {quality}p...")
-        file_path = utils.download_video(url, quality, query.from_user.id)
-        
-        # Увеличиваем счетчик скачиваний
-        utils.increment_download_count(query.from_user.id)
+
+        async def on_position(position: int, eta: float):
+            if position == 0:
+                text = f"⏳ Скачиваю в {quality}p..."
+            else:
+                text = f"🕐 Вы в очереди: {position}\n⏱ Ожидание: ~{max(1, round(eta / 60))} мин"
+            try:
+                await query.edit_message_text(text)
+            except Exception as e:
+                logger.debug(f"Не удалось обновить позицию в очереди: {e}")
+
+        file_path = await utils.acquire_video(url, quality, query.from_user.id, on_position)
 
         if not os.path.exists(file_path):
             await query.edit_message_text("❌ Ошибка: файл не был создан")
-            return
+            return False
 
         file_size = os.path.getsize(file_path)
         if file_size > config.TELEGRAM_LIMIT:
             await query.edit_message_text("⚠️ Файл слишком большой для Telegram (>2 ГБ)")
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass
-            return
+            return False
 
-        # Отправляем видео
-        with open(file_path, "rb") as f:
-            await query.message.reply_video(
+        # Отправляем видео. Побайтового прогресса загрузки PTB не дает — показываем этап
+        progress.unwatch(watch_id)
+        await query.edit_message_text(f"📤 Отправляю видео ({file_size / 1024 / 1024:.1f} МБ)...")
+        with open(file_path, "rb") as f, metrics.timer("upload", cached="0"):
+            sent = await query.message.reply_video(
                 video=f,
                 caption=f"📹 Видео в качестве {quality}p"
             )
+        media = sent.video or sent.document
+        if media:
+            utils.remember_file_id(media_key, media.file_id)
+        outcome = "sent"
+        return True
 
-        # Получаем оставшиеся скачивания
-        remaining = utils.get_remaining_downloads(query.from_user.id, config.MAX_DAILY_DOWNLOADS)
-        await query.edit_message_text(f"✅ Видео отправлено!\n\n📊 Осталось скачиваний: {remaining}/{config.MAX_DAILY_DOWNLOADS}")
-
-        # Удаляем временный файл
-        try:
-            os.remove(file_path)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить файл {file_path}: {e}")
-            
     except Exception as e:
         logger.error(f"Ошибка скачивания: {e}")
         await query.edit_message_text(f"❌ Ошибка скачивания: {str(e)}")
+        return False
+    finally:
+        metrics.inc("bot_downloads_total", extractor=extractor, quality=quality, outcome=outcome)
+        progress.unwatch(watch_id)
+        # Удаляем временный файл после последнего получателя
+        if file_path:
+            utils.release_video(file_path)
+
+
+# --- события подписки на каналы ---
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member = update.chat_member
+    utils.update_membership(member.new_chat_member.user.id, member.chat, member.new_chat_member.status)
+
+
+# --- служебные HTTP-адреса ---
+def health():
+    load_info = utils.get_system_load()
+    return httpserver.json_response({
+        "status": "ok",
+        "mode": config.BOT_MODE,
+        "active_downloads": load_info["active_downloads"],
+        "queue_depth": load_info["queue_depth"],
+    })
+
+
+def metrics_page():
+    return 200, "text/plain; version=0.0.4", metrics.render()
+
+
+def _collect_api_metrics() -> list:
+    api_stats = ratelimit.get_stats()
+    progress_stats = progress.get_stats()
+    return [
+        ("bot_api_requests_total", {}, api_stats["requests"]),
+        ("bot_api_throttled_total", {}, api_stats["throttled"]),
+        ("bot_api_retry_after_total", {}, api_stats["retry_after"]),
+        ("bot_progress_edits_total", {}, progress_stats["edits"]),
+        ("bot_progress_watchers", {}, progress_stats["watchers"]),
+    ]
+
+
+metrics.describe("bot_links_total", "counter", "Присланные ссылки по сайту")
+metrics.describe("bot_api_requests_total", "counter", "Запросы к Telegram API")
+metrics.describe("bot_api_throttled_total", "counter", "Запросы, ждавшие лимита")
+metrics.describe("bot_api_retry_after_total", "counter", "Полученные RetryAfter")
+metrics.describe("bot_progress_edits_total", "counter", "Правки сообщений с прогрессом")
+metrics.describe("bot_progress_watchers", "gauge", "Сообщения, показывающие прогресс")
+metrics.register_collector(_collect_api_metrics)
+
+
+def _collect_storage_metrics() -> list:
+    storage_stats = storage.get_stats()
+    return [
+        ("bot_storage_pending", {}, storage_stats["pending"]),
+        ("bot_storage_writes_total", {}, storage_stats["writes"]),
+        ("bot_storage_errors_total", {}, storage_stats["errors"]),
+    ]
+
+
+metrics.describe("bot_storage_pending", "gauge", "Изменения состояния, ждущие записи в SQLite")
+metrics.describe("bot_storage_writes_total", "counter", "Записанные в SQLite изменения состояния")
+metrics.describe("bot_storage_errors_total", "counter", "Ошибки фоновой записи состояния")
+metrics.register_collector(_collect_storage_metrics)
+
+
+async def post_init(app: Application):
+    progress.start()
+    metrics.start()
+    utils.start_janitor()
+    utils.start_admission()
+    profiling.start_watchdog()
+    if config.HEALTH_PORT:
+        httpserver.add_route("/health", health)
+        httpserver.add_route("/metrics", metrics_page)
+        await httpserver.start(config.HEALTH_HOST, config.HEALTH_PORT)
+
+
+async def post_shutdown(app: Application):
+    await httpserver.stop()
+    progress.stop()
+    metrics.stop()
+    utils.stop_janitor()
+    utils.stop_admission()
+    profiling.stop_watchdog()
+    utils.shutdown_download_executor()
+    storage.close()
 
 
 def main():
-    app = Application.builder().token(config.BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("limits", limits))
-    app.add_handler(CommandHandler("analytics", analytics))
-    app.add_handler(CommandHandler("system", system))
-    app.add_handler(CommandHandler("userstats", userstats))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(CallbackQueryHandler(button))
-    print("✅ Бот запущен")
-    app.run_polling()
+    utils.load_state()
+    app = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .rate_limiter(ratelimit.TelegramRateLimiter())
+        .concurrent_updates(config.CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    watch = profiling.watch_handler
+    app.add_handler(CommandHandler("start", watch(start)))
+    app.add_handler(CommandHandler("limits", watch(limits)))
+    app.add_handler(CommandHandler("analytics", watch(analytics)))
+    app.add_handler(CommandHandler("system", watch(system)))
+    app.add_handler(CommandHandler("userstats", watch(userstats)))
+    app.add_handler(CommandHandler("profile", watch(profile)))
+    app.add_handler(CommandHandler("memprofile", watch(memprofile)))
+    app.add_handler(CommandHandler("lag", watch(lag)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, watch(handle_message)))
+    app.add_handler(CallbackQueryHandler(watch(button)))
+    app.add_handler(ChatMemberHandler(watch(chat_member_update), ChatMemberHandler.CHAT_MEMBER))
+    print(f"✅ Бот запущен ({config.BOT_MODE})")
+    # chat_member не приходит по умолчанию — запрашиваем все типы обновлений
+    if config.BOT_MODE == "webhook":
+        if not config.WEBHOOK_URL:
+            raise SystemExit("Для режима webhook нужен WEBHOOK_URL")
+        app.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class BoundedCache:
+    """
+    Кеш с ограничением размера (LRU) и временем жизни записей (TTL).
+    Все операции O(1); запись хранится как кортеж (значение, истекает_в).
+    """
+
+    __slots__ = ("name", "maxsize", "ttl", "_data", "_lock",
+                 "hits", "misses", "evictions", "expirations")
+
+    def __init__(self, name: str, maxsize: int, ttl: float = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # кеш читается и из пулов потоков (метаданные), поэтому нужна блокировка
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._data.keys())
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -1,4 +1,5 @@
 import os
+import secrets
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -26,3 +27,145 @@ MAX_DAILY_DOWNLOADS = 5
 MAX_CONCURRENT_DOWNLOADS = 2  # Максимум 2 одновременных скачивания
 MAX_FILE_SIZE = 400 * 1024 * 1024  # 400MB для лучшего качества (было 200MB)
 CLEANUP_INTERVAL = 3600  # Очистка временных файлов каждый час
+
+# Временные файлы скачиваний
+DOWNLOADS_DIR = "downloads"
+DOWNLOADS_QUOTA = 10 * 1024 * 1024 * 1024   # не больше 10GB под временные файлы
+MIN_FREE_DISK = 2 * 1024 * 1024 * 1024      # оставлять свободными на диске
+ORPHAN_FILE_AGE = 2 * 3600                  # файл без изменений дольше — считается брошенным
+
+# Пул для скачиваний: "thread" или "process" (процессы обходят GIL при разборе yt-dlp)
+DOWNLOAD_POOL_TYPE = os.getenv("DOWNLOAD_POOL_TYPE", "thread")
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", str(MAX_CONCURRENT_DOWNLOADS)))
+
+# Кэш метаданных yt-dlp между выбором качества и скачиванием
+INFO_CACHE_TTL = 600   # ссылки на форматы у YouTube живут несколько часов, берем с запасом
+INFO_CACHE_SIZE = 256
+
+# Получение списка форматов в фоне
+METADATA_WORKERS = 4
+METADATA_TIMEOUT = 30  # секунд, после этого показываем стандартные качества
+
+# Очередь скачиваний
+MAX_QUEUE_SIZE = 20          # Сколько заданий может ждать в очереди
+MAX_USER_DOWNLOADS = 2       # Заданий одного пользователя (в очереди + в работе)
+
+# Сколько доверять статусу подписки, полученному из события chat_member (бот должен быть админом каналов)
+CHAT_MEMBER_EVENT_TTL = 24 * 3600
+
+# Размеры кешей в памяти (старые записи вытесняются, чтобы не расти бесконечно)
+URL_CACHE_SIZE = 10000
+URL_CACHE_TTL = 3600                 # клавиатура выбора качества живет час
+SUBSCRIPTION_CACHE_SIZE = 50000
+DOWNLOAD_COUNTS_CACHE_SIZE = 100000
+FILE_ID_CACHE_SIZE = 50000           # file_id отправленных видео (не истекают, вытесняются редко нужные)
+
+# Хранилище состояния (счетчики, аналитика, кеши) — SQLite в режиме WAL
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot_state.db")
+STORAGE_FLUSH_INTERVAL = 2   # секунд между фоновыми записями
+STORAGE_BATCH_SIZE = 500     # записать раньше, если накопилось столько изменений
+
+# Сколько последних дней хранить в дневной статистике
+ANALYTICS_DAYS = 30
+
+# Прогресс скачивания в чате (ограничения Telegram: ~1 правка в секунду на чат, ~30 в секунду всего)
+PROGRESS_EDIT_INTERVAL = 3            # секунд между правками в одном чате
+PROGRESS_GLOBAL_EDITS_PER_SECOND = 5  # правок прогресса в секунду на весь бот
+PROGRESS_TICK = 1                     # период проверки новых статусов, сек
+
+# Исходящие запросы к Telegram API
+API_GLOBAL_RATE = 25          # запросов в секунду на весь бот (лимит Telegram ~30)
+API_CHAT_RATE = 1             # запросов в секунду в один чат
+API_CHAT_BURST = 3            # короткий всплеск в один чат
+API_CHAT_BUCKETS_MAX = 10000  # сколько чатов отслеживать одновременно
+API_MAX_RETRIES = 3           # повторов после RetryAfter
+
+# Оценка размера до скачивания: качества, которые не влезают, помечаются,
+# а при скачивании выбирается лучшая комбинация форматов в пределах лимита
+HIDE_OVERSIZED_QUALITIES = False
+
+# Подгонка под лимит через ffmpeg (перекодирование или только смена контейнера)
+ENABLE_TRANSCODE = os.getenv("ENABLE_TRANSCODE", "1") == "1"
+FFPROBE_PATH = "ffprobe"
+TRANSCODE_WORKERS = 1              # отдельный маленький пул процессов: CPU всего 2
+TRANSCODE_THREADS = 1              # потоков ffmpeg на одно перекодирование
+TRANSCODE_NICE = 10                # пониженный приоритет процессов перекодирования
+TRANSCODE_PRESET = "veryfast"
+TRANSCODE_AUDIO_BITRATE = 128_000
+TRANSCODE_MIN_VIDEO_BITRATE = 200_000
+TRANSCODE_MAX_INPUT = 1200 * 1024 * 1024   # больше не качаем даже для сжатия (при ENABLE_TRANSCODE)
+
+# Повторы скачивания по типу ошибки: (сколько повторов, базовая задержка в сек; растет вдвое)
+DOWNLOAD_RETRY_POLICY = {
+    "permanent": (0, 0),    # приватное/удаленное видео, слишком большой файл — повтор бессмысленен
+    "throttled": (2, 30),   # 429 и подобное — ждем дольше
+    "network": (3, 3),      # таймауты, обрывы, 5xx, протухшие ссылки
+    "merge": (1, 0),        # ошибка склейки ffmpeg — пробуем формат без склейки
+    "unknown": (1, 5),
+}
+DOWNLOAD_MAX_ATTEMPTS = 5
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")           # внешний адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token; без настройки — случайный на каждый запуск
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))  # обновлений, обрабатываемых параллельно
+
+# Служебный HTTP-сервер (/health); 0 — выключен
+HEALTH_HOST = os.getenv("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8080"))
+
+# Где выполняются скачивания: "local" — пул внутри процесса бота,
+# "queue" — отдельные процессы worker.py через общую очередь в SQLite.
+# В режиме queue воркеры и бот работают на одной машине с общим файлом очереди и папкой DOWNLOADS_DIR:
+# SQLite в режиме WAL держит общую память рядом с файлом и на сетевых дисках может испортить базу
+DOWNLOAD_BACKEND = os.getenv("DOWNLOAD_BACKEND", "local")
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobs.db")
+JOB_QUEUE_INFLIGHT = int(os.getenv("JOB_QUEUE_INFLIGHT", "8"))  # заданий в общей очереди от бота одновременно
+JOB_POLL_INTERVAL = 1          # как часто бот проверяет задание и воркер ищет новое, сек
+WORKER_HEARTBEAT = 10          # как часто воркер отмечается по текущему заданию, сек
+JOB_STALE_TIMEOUT = 120        # задание без отметок дольше — воркер считается упавшим, задание возвращается в очередь
+JOB_RETENTION = 24 * 3600      # сколько хранить завершенные задания
+
+# Метрики: период замера задержки event loop, сек (выдаются на /metrics служебного HTTP-сервера)
+LOOP_LAG_INTERVAL = 0.5
+
+# Предзагрузка: пока пользователь выбирает качество, заранее качаем то, которое на этом
+# сайте выбирают чаще всего. Только в свободный слот; обычные скачивания ее вытесняют
+ENABLE_PREFETCH = os.getenv("ENABLE_PREFETCH", "0") == "1"
+PREFETCH_MIN_CHOICES = 20   # выборов на сайте, начиная с которых статистике можно доверять
+PREFETCH_MIN_SHARE = 0.6    # минимальная доля самого частого качества среди предложенных
+PREFETCH_TTL = 60           # сколько ждать выбора пользователя, сек
+
+# Адаптивный допуск: MAX_CONCURRENT_DOWNLOADS — только стартовый лимит, дальше он
+# подстраивается по /proc/loadavg, MemAvailable и свободному диску. Задание
+# допускается, если его оценка памяти (по форматам) влезает в свободную память
+ADAPTIVE_ADMISSION = os.getenv("ADAPTIVE_ADMISSION", "1") == "1"
+ADMISSION_MIN_CONCURRENT = 1
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "4"))
+ADMISSION_INTERVAL = 5                      # как часто перечитывать показатели, сек
+ADMISSION_HIGH_LOAD = 1.5                   # loadavg на ядро, выше — лимит уменьшается
+ADMISSION_LOW_LOAD = 0.7                    # ниже — лимит можно увеличить, если есть очередь
+ADMISSION_MEM_RESERVE = 300 * 1024 * 1024   # память, которую не отдаем скачиваниям
+ADMISSION_JOB_MEMORY = 60 * 1024 * 1024     # yt-dlp на одно задание без склейки
+ADMISSION_MAX_SKIPS = 3                     # сколько раз легкие задания могут обойти не влезшее в память
+# Склейка видео и аудио ffmpeg'ом: дополнительная память по высоте видео
+ADMISSION_MERGE_MEMORY = {
+    480: 100 * 1024 * 1024,
+    720: 200 * 1024 * 1024,
+    1080: 450 * 1024 * 1024,
+    2160: 1000 * 1024 * 1024,
+}
+
+# Профилирование по командам администратора (/profile, /memprofile, /lag)
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP_N = 20
+TRACEMALLOC_FRAMES = 1      # кадров стека на выделение памяти: больше — точнее, но медленнее
+# Сторож event loop: если loop не отвечает дольше порога, в лог пишется стек того, что его заняло
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", "0.5"))
+STALL_STACK_DEPTH = 8
@@ -0,0 +1,75 @@
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Небольшой HTTP-сервер для служебных адресов (/health и т.п.) без внешних зависимостей
+_routes = {}   # {path: handler() -> (status, content_type, body)}
+_server = None
+
+_REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def add_route(path: str, handler):
+    """Зарегистрировать GET-обработчик: handler() возвращает (статус, content-type, тело)"""
+    _routes[path] = handler
+
+
+def json_response(data: dict, status: int = 200):
+    return status, "application/json", json.dumps(data, ensure_ascii=False)
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        # Заголовки не нужны, но их надо дочитать
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+        parts = request_line.decode("latin-1").split()
+        method, path = (parts[0], parts[1].split("?")[0]) if len(parts) >= 2 else ("", "")
+        handler = _routes.get(path)
+        if handler is None:
+            status, content_type, body = 404, "text/plain", "not found"
+        elif method != "GET":
+            status, content_type, body = 405, "text/plain", "method not allowed"
+        else:
+            try:
+                result = handler()
+                if asyncio.iscoroutine(result):
+                    result = await result
+                status, content_type, body = result
+            except Exception as e:
+                logger.error(f"Ошибка обработчика {path}: {e}")
+                status, content_type, body = 500, "text/plain", "error"
+
+        payload = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start(host: str, port: int):
+    global _server
+    if _server is None:
+        _server = await asyncio.start_server(_handle, host, port)
+        logger.info(f"Служебный HTTP-сервер: http://{host}:{port} ({', '.join(sorted(_routes))})")
+
+
+async def stop():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,167 @@
+import json
+import time
+import uuid
+import sqlite3
+import config
+
+# Очередь заданий скачивания в SQLite: бот ставит задания, процессы worker.py
+# на той же машине их выполняют. Только одна машина: WAL работает через общую
+# память (-shm), а по сетевой файловой системе SQLite не поддерживается и портит базу.
+# Статусы: queued -> running -> done | failed; cancelled — задание больше никому не нужно
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    info TEXT,
+    status TEXT NOT NULL,
+    worker TEXT,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(config.JOB_QUEUE_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init():
+    conn = _connect()
+    try:
+        conn.executescript(_SCHEMA)
+    finally:
+        conn.close()
+
+
+def enqueue(url: str, quality: str, info: dict = None) -> str:
+    """Поставить задание; метаданные передаются, чтобы воркеру не извлекать их заново"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, url, quality, info, status, created, updated) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, url, str(quality), json.dumps(info) if info else None, now, now),
+        )
+    finally:
+        conn.close()
+    return job_id
+
+
+def claim(worker_id: str) -> dict | None:
+    """Забрать самое старое задание из очереди (атомарно между процессами)"""
+    conn = _connect()
+    try:
+        # BEGIN IMMEDIATE берет блокировку записи сразу — два воркера не заберут одно задание
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id, url, quality, info FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', worker = ?, updated = ? WHERE id = ?",
+            (worker_id, time.time(), row[0]),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        # Если не удался сам BEGIN, транзакции нет — ROLLBACK скрыл бы исходную ошибку
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return {"id": row[0], "url": row[1], "quality": row[2], "info": json.loads(row[3]) if row[3] else None}
+
+
+def _update(job_id: str, sql: str, params: tuple):
+    conn = _connect()
+    try:
+        conn.execute(f"UPDATE jobs SET {sql}, updated = ? WHERE id = ?", params + (time.time(), job_id))
+    finally:
+        conn.close()
+
+
+def heartbeat(job_id: str, progress: str = None):
+    """Отметить, что воркер жив; заодно сохранить текст прогресса"""
+    if progress is None:
+        _update(job_id, "status = status", ())
+    else:
+        _update(job_id, "progress = ?", (progress,))
+
+
+def complete(job_id: str, result: str):
+    _update(job_id, "status = 'done', result = ?", (result,))
+
+
+def fail(job_id: str, error: str):
+    _update(job_id, "status = 'failed', error = ?", (error,))
+
+
+def cancel(job_id: str):
+    """Отменить задание, если его еще не забрали"""
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id),
+        )
+    finally:
+        conn.close()
+
+
+def get(job_id: str) -> dict | None:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT status, progress, result, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return {"status": row[0], "progress": row[1], "result": row[2], "error": row[3]}
+
+
+def requeue_stale(timeout: float) -> int:
+    """Вернуть в очередь задания воркеров, которые перестали отвечать"""
+    conn = _connect()
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, updated = ? WHERE status = 'running' AND updated < ?",
+            (time.time(), time.time() - timeout),
+        )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def purge(older_than: float) -> int:
+    """Удалить завершенные задания старше older_than секунд"""
+    conn = _connect()
+    try:
+        cursor = conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated < ?",
+            (time.time() - older_than,),
+        )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def get_stats() -> dict:
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        workers = conn.execute("SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = 'running'").fetchone()[0]
+    finally:
+        conn.close()
+    return {"by_status": dict(rows), "busy_workers": workers}
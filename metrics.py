@@ -0,0 +1,201 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+import config
+
+logger = logging.getLogger(__name__)
+
+# Метрики в памяти процесса и их выдача в текстовом формате Prometheus.
+# Счетчики и гистограммы пишутся из любых потоков; значения "на сейчас"
+# (очередь, кеши) собираются функциями-сборщиками в момент запроса /metrics
+
+# Границы корзин гистограмм длительности, сек
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_counters = {}      # {(name, labels): значение}
+_histograms = {}    # {(name, labels): [счетчики по корзинам + переполнение, сумма, количество]}
+_collectors = []    # функции без аргументов -> [(name, labels: dict, значение)]
+_descriptions = {}  # {name: (тип, описание)}
+_lag = {"last": 0.0, "max": 0.0}
+_lag_task = None
+
+
+def describe(name: str, metric_type: str, help_text: str):
+    _descriptions[name] = (metric_type, help_text)
+
+
+describe("bot_stage_seconds", "histogram", "Длительность этапов обработки запроса")
+describe("bot_event_loop_lag_seconds", "histogram", "Задержка event loop")
+describe("bot_downloads_total", "counter", "Запросы видео по сайту, качеству и исходу")
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    key = _key(name, labels)
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        else:
+            entry[0][-1] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+@contextmanager
+def timer(stage: str, **labels):
+    """Засечь длительность этапа (работает и вокруг await)"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe("bot_stage_seconds", time.monotonic() - started, stage=stage, **labels)
+
+
+def register_collector(collector):
+    """Добавить функцию, которая при выдаче метрик возвращает [(name, labels, значение)]"""
+    _collectors.append(collector)
+
+
+# --- задержка event loop ---
+async def _lag_loop():
+    interval = config.LOOP_LAG_INTERVAL
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        # Все, что сверх заказанного сна — время, когда loop был занят чужим кодом
+        lag = max(0.0, time.monotonic() - started - interval)
+        _lag["last"] = lag
+        _lag["max"] = max(_lag["max"], lag)
+        observe("bot_event_loop_lag_seconds", lag)
+
+
+def start():
+    """Запустить замер задержки event loop (внутри работающего loop)"""
+    global _lag_task
+    if _lag_task is None:
+        _lag_task = asyncio.create_task(_lag_loop())
+
+
+def stop():
+    global _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+
+
+def get_loop_lag() -> dict:
+    return dict(_lag)
+
+
+# --- выдача ---
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    samples = {}  # {name: [строки]}
+    with _lock:
+        counters = list(_counters.items())
+        histograms = [(key, [list(entry[0]), entry[1], entry[2]]) for key, entry in _histograms.items()]
+
+    for (name, labels), value in counters:
+        samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), (counts, total, count) in histograms:
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                labels = tuple(sorted((k, str(v)) for k, v in labels.items()))
+                samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+        except Exception as e:
+            logger.warning(f"Ошибка сборщика метрик: {e}")
+
+    output = []
+    for name in sorted(samples):
+        metric_type, help_text = _descriptions.get(name, ("gauge", name))
+        output.append(f"# HELP {name} {help_text}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(samples[name])
+    return "\n".join(output) + "\n"
+
+
+def _quantile(counts: list, count: int, q: float) -> float:
+    """Оценка квантиля по корзинам: верхняя граница корзины, в которую он попал"""
+    threshold = q * count
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, counts):
+        cumulative += bucket_count
+        if cumulative >= threshold:
+            return bound
+    return float("inf")
+
+
+def get_histogram_summary(name: str, label: str = None) -> dict:
+    """{значение метки: {"count", "avg", "p50", "p95"}} гистограммы name, остальные метки суммируются"""
+    groups = {}
+    with _lock:
+        for (histogram_name, labels), (counts, total, count) in _histograms.items():
+            if histogram_name != name:
+                continue
+            group = dict(labels).get(label, "") if label else ""
+            entry = groups.setdefault(group, [[0] * (len(BUCKETS) + 1), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+            entry[2] += count
+    return {
+        group: {
+            "count": count,
+            "avg": total / count if count else 0,
+            "p50": _quantile(counts, count, 0.5),
+            "p95": _quantile(counts, count, 0.95),
+        }
+        for group, (counts, total, count) in sorted(groups.items())
+    }
+
+
+def get_stage_summary() -> dict:
+    """{этап: {"count", "avg", "p50", "p95"}} по всем меткам этапа"""
+    return get_histogram_summary("bot_stage_seconds", "stage")
+
+
+def get_counter_totals(name: str, label: str) -> dict:
+    """Сумма счетчика name в разрезе одной метки"""
+    totals = {}
+    with _lock:
+        for (counter_name, labels), value in _counters.items():
+            if counter_name == name:
+                key = dict(labels).get(label, "")
+                totals[key] = totals.get(key, 0) + value
+    return totals
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import tempfile
+import threading
+import traceback
+import tracemalloc
+from collections import deque
+from functools import wraps
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Профилирование по командам администратора и поиск того, что блокирует event loop.
+# cProfile видит только поток, в котором включен, — поток event loop; скачивания
+# в пуле потоков в профиль не попадают, но и тормозят они не всех пользователей сразу
+
+_capture = None             # {"kind", "started", "seconds", "on_done", "timer", "profiler" | "baseline", "own_tracing"}
+_active_handlers = {}       # {задача asyncio: имя обработчика}
+_stalls = deque(maxlen=20)  # последние зависания event loop
+_watchdog = {"loop": None, "thread_id": None, "beat": None, "stalled_beat": None, "task": None, "thread": None, "stop": None}
+
+metrics.describe("bot_handler_seconds", "histogram", "Длительность обработчиков обновлений")
+metrics.describe("bot_loop_stalls_total", "counter", "Зависания event loop дольше SLOW_CALLBACK_THRESHOLD")
+
+
+# --- захват профиля ---
+def start(kind: str, seconds: int, on_done) -> int:
+    """
+    Начать захват: kind — "cpu" (cProfile) или "memory" (tracemalloc).
+    Через seconds секунд (или по finish) результат передается корутине on_done(result).
+    """
+    global _capture
+    if _capture is not None:
+        raise Exception(f"Уже идет захват {_capture['kind']}, осталось {_remaining():.0f} сек")
+    seconds = max(1, min(seconds, config.PROFILE_MAX_SECONDS))
+    capture = {"kind": kind, "started": time.monotonic(), "seconds": seconds, "on_done": on_done}
+    if kind == "cpu":
+        capture["profiler"] = cProfile.Profile()
+        capture["profiler"].enable()
+    else:
+        # Если трассировку включили при запуске (PYTHONTRACEMALLOC), не выключаем ее после захвата
+        capture["own_tracing"] = not tracemalloc.is_tracing()
+        if capture["own_tracing"]:
+            tracemalloc.start(config.TRACEMALLOC_FRAMES)
+        capture["baseline"] = tracemalloc.take_snapshot()
+    capture["timer"] = asyncio.create_task(_finish_later(seconds))
+    _capture = capture
+    logger.info(f"Начат захват {kind} на {seconds} сек")
+    return seconds
+
+
+def _remaining() -> float:
+    return max(0.0, _capture["seconds"] - (time.monotonic() - _capture["started"]))
+
+
+async def _finish_later(seconds: int):
+    await asyncio.sleep(seconds)
+    await finish()
+
+
+async def finish(kind: str = None) -> bool:
+    """Остановить захват досрочно или по таймеру и отдать результат; False — захвата kind нет"""
+    global _capture
+    capture = _capture
+    if capture is None or (kind is not None and capture["kind"] != kind):
+        return False
+    _capture = None
+    if capture["timer"] is not asyncio.current_task():
+        capture["timer"].cancel()
+    result = _stop_cpu(capture) if capture["kind"] == "cpu" else _stop_memory(capture)
+    logger.info(f"Захват {capture['kind']} завершен через {result['seconds']:.0f} сек")
+    try:
+        await capture["on_done"](result)
+    except Exception as e:
+        logger.error(f"Не удалось отправить результат профилирования: {e}")
+    return True
+
+
+def _short_path(filename: str) -> str:
+    return os.path.join(*filename.split(os.sep)[-2:]) if os.sep in filename else filename
+
+
+def _stop_cpu(capture: dict) -> dict:
+    profiler = capture["profiler"]
+    profiler.disable()
+    elapsed = time.monotonic() - capture["started"]
+    path = os.path.join(tempfile.gettempdir(), f"profile-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+    profiler.dump_stats(path)
+
+    # Сортируем по собственному времени: по суммарному наверху всегда run_forever и обработчики
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:config.PROFILE_TOP_N]
+    lines = [f"CPU-профиль event loop за {elapsed:.0f} сек (топ {len(top)} по собственному времени)", "собств. / всего, сек  вызовов  функция"]
+    for (filename, lineno, func), (_, calls, own, total, _) in top:
+        lines.append(f"{own:7.3f} / {total:7.3f}  {calls:7d}  {func} ({_short_path(filename)}:{lineno})")
+    return {"kind": "cpu", "seconds": elapsed, "text": "\n".join(lines), "path": path}
+
+
+def _stop_memory(capture: dict) -> dict:
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    if capture["own_tracing"]:
+        tracemalloc.stop()
+    elapsed = time.monotonic() - capture["started"]
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    diff = snapshot.filter_traces(ignore).compare_to(capture["baseline"].filter_traces(ignore), "lineno")
+    top = diff[:config.PROFILE_TOP_N]
+    kb = 1024
+    lines = [
+        f"Память за {elapsed:.0f} сек: отслежено {current // kb} КБ, пик {peak // kb} КБ",
+        f"Топ {len(top)} строк по приросту (КБ, блоков):",
+    ]
+    for stat in top:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size_diff / kb:+9.1f}  {stat.count_diff:+6d}  {_short_path(frame.filename)}:{frame.lineno}  (всего {stat.size // kb} КБ)")
+    return {"kind": "memory", "seconds": elapsed, "text": "\n".join(lines), "path": None}
+
+
+def get_capture() -> dict | None:
+    if _capture is None:
+        return None
+    return {"kind": _capture["kind"], "seconds": _capture["seconds"], "remaining": _remaining()}
+
+
+# --- обработчики ---
+def watch_handler(callback):
+    """Обертка обработчика: длительность в метриках, имя — в отчете о зависании event loop"""
+    name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        task = asyncio.current_task()
+        _active_handlers[task] = name
+        started = time.monotonic()
+        try:
+            return await callback(update, context)
+        finally:
+            _active_handlers.pop(task, None)
+            metrics.observe("bot_handler_seconds", time.monotonic() - started, handler=name)
+
+    return wrapper
+
+
+# --- сторож event loop ---
+async def _beat_loop():
+    interval = config.SLOW_CALLBACK_THRESHOLD / 4
+    while True:
+        previous = _watchdog["beat"]
+        _watchdog["beat"] = time.monotonic()
+        # Loop снова свободен: уточняем, сколько длилось замеченное зависание
+        if previous is not None and _watchdog["stalled_beat"] == previous and _stalls:
+            _stalls[-1]["blocked"] = _watchdog["beat"] - previous - interval
+        await asyncio.sleep(interval)
+
+
+def _watch(stop: threading.Event):
+    """Поток-сторож: если loop давно не отмечался, записать, на чем он стоит"""
+    threshold = config.SLOW_CALLBACK_THRESHOLD
+    while not stop.wait(threshold / 4):
+        beat = _watchdog["beat"]
+        if beat is None or _watchdog["stalled_beat"] == beat:
+            continue
+        blocked = time.monotonic() - beat - threshold / 4
+        if blocked < threshold:
+            continue
+        _watchdog["stalled_beat"] = beat
+        frame = sys._current_frames().get(_watchdog["thread_id"])
+        stack = traceback.format_stack(frame)[-config.STALL_STACK_DEPTH:] if frame else []
+        try:
+            task = asyncio.current_task(_watchdog["loop"])
+        except RuntimeError:
+            task = None
+        handler = _active_handlers.get(task)
+        _stalls.append({"time": time.time(), "blocked": blocked, "handler": handler, "stack": [s.rstrip() for s in stack]})
+        # Имена прочих задач (Task-123) в метку не идут — их слишком много
+        metrics.inc("bot_loop_stalls_total", handler=handler or "other")
+        logger.warning(f"Event loop занят дольше {blocked:.2f} сек ({handler or 'вне обработчиков'}):\n" + "".join(stack))
+
+
+def start_watchdog():
+    """Запустить сторожа (внутри работающего loop)"""
+    if _watchdog["task"] is not None:
+        return
+    _watchdog["loop"] = asyncio.get_running_loop()
+    _watchdog["thread_id"] = threading.get_ident()
+    _watchdog["task"] = asyncio.create_task(_beat_loop())
+    _watchdog["stop"] = threading.Event()
+    _watchdog["thread"] = threading.Thread(target=_watch, args=(_watchdog["stop"],), name="loop-watchdog", daemon=True)
+    _watchdog["thread"].start()
+
+
+def stop_watchdog():
+    if _watchdog["task"] is not None:
+        _watchdog["task"].cancel()
+        _watchdog["stop"].set()
+        _watchdog["thread"].join()
+        _watchdog["task"] = None
+        _watchdog["beat"] = None
+
+
+def get_stalls() -> list:
+    return list(_stalls)
@@ -0,0 +1,135 @@
+import time
+import asyncio
+import logging
+import threading
+import config
+
+logger = logging.getLogger(__name__)
+
+# Последний статус каждого задания: {job_key: текст}. Пишется из потоков скачивания
+_job_status = {}
+_status_lock = threading.Lock()
+# Сообщения, показывающие прогресс: {watch_id: {"job_key", "chat_id", "edit", "sent"}}
+_watchers = {}
+_last_chat_edit = {}    # {chat_id: время последнего редактирования}
+_updater_task = None
+_stats = {"edits": 0, "skipped": 0, "errors": 0}
+
+
+def report(job_key, text: str):
+    """Сохранить новый статус задания (можно вызывать из любого потока)"""
+    with _status_lock:
+        _job_status[job_key] = text
+
+
+def get_status(job_key) -> str | None:
+    with _status_lock:
+        return _job_status.get(job_key)
+
+
+def finish(job_key):
+    with _status_lock:
+        _job_status.pop(job_key, None)
+
+
+def watch(watch_id: str, job_key, chat_id: int, edit):
+    """
+    Показывать прогресс задания в сообщении. edit(text) — корутина,
+    которая редактирует сообщение; вызывается не чаще лимитов ниже.
+    """
+    _watchers[watch_id] = {"job_key": job_key, "chat_id": chat_id, "edit": edit, "sent": None}
+
+
+def unwatch(watch_id: str):
+    _watchers.pop(watch_id, None)
+
+
+def make_download_hook(job_key, quality: str):
+    """
+    progress_hook для yt-dlp: форматирует прогресс не чаще раза в секунду,
+    само редактирование сообщений делает _updater_loop
+    """
+    last = [0.0]
+
+    def hook(d: dict):
+        now = time.time()
+        if d.get("status") == "finished":
+            report(job_key, f"🔧 Обрабатываю видео {quality}p...")
+            return
+        if d.get("status") != "downloading" or now - last[0] < 1:
+            return
+        last[0] = now
+        report(job_key, format_download_progress(d, quality))
+
+    return hook
+
+
+def format_download_progress(d: dict, quality: str) -> str:
+    downloaded = d.get("downloaded_bytes") or 0
+    total = d.get("total_bytes") or d.get("total_bytes_estimate")
+    speed = d.get("speed")
+    eta = d.get("eta")
+
+    text = f"⏳ Скачиваю в {quality}p"
+    if total:
+        text += f": {downloaded * 100 / total:.0f}% ({downloaded / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f} МБ)"
+    else:
+        text += f": {downloaded / 1024 / 1024:.1f} МБ"
+    if speed:
+        text += f"\n🚀 {speed / 1024 / 1024:.1f} МБ/с"
+    if eta is not None:
+        text += f"\n⏱ Осталось: {int(eta) // 60}:{int(eta) % 60:02d}"
+    return text
+
+
+async def _updater_loop():
+    while True:
+        await asyncio.sleep(config.PROGRESS_TICK)
+        now = time.time()
+        # Глобальный бюджет правок на один тик, чтобы не упереться во flood-лимиты
+        budget = max(1, int(config.PROGRESS_GLOBAL_EDITS_PER_SECOND * config.PROGRESS_TICK))
+        with _status_lock:
+            statuses = dict(_job_status)
+
+        for watcher in list(_watchers.values()):
+            text = statuses.get(watcher["job_key"])
+            if not text or text == watcher["sent"]:
+                continue
+            if now - _last_chat_edit.get(watcher["chat_id"], 0) < config.PROGRESS_EDIT_INTERVAL:
+                continue
+            if budget <= 0:
+                _stats["skipped"] += 1
+                continue
+            budget -= 1
+            _last_chat_edit[watcher["chat_id"]] = now
+            watcher["sent"] = text
+            try:
+                await watcher["edit"](text)
+                _stats["edits"] += 1
+            except Exception as e:
+                _stats["errors"] += 1
+                logger.debug(f"Не удалось обновить прогресс: {e}")
+
+        # Забываем чаты без активных сообщений, чтобы словарь не рос
+        active_chats = {watcher["chat_id"] for watcher in _watchers.values()}
+        for chat_id in list(_last_chat_edit):
+            if chat_id not in active_chats:
+                del _last_chat_edit[chat_id]
+
+
+def start():
+    """Запустить фоновое обновление сообщений (внутри работающего event loop)"""
+    global _updater_task
+    if _updater_task is None:
+        _updater_task = asyncio.create_task(_updater_loop())
+
+
+def stop():
+    global _updater_task
+    if _updater_task is not None:
+        _updater_task.cancel()
+        _updater_task = None
+
+
+def get_stats() -> dict:
+    return {"watchers": len(_watchers), "jobs": len(_job_status), **_stats}
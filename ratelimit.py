@@ -0,0 +1,146 @@
+import time
+import asyncio
+import logging
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import config
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: ответы пользователям идут раньше правок прогресса.
+# Запрос помечается низким приоритетом через rate_limit_args={"priority": "low"}
+PRIORITY_HIGH = "high"
+PRIORITY_LOW = "low"
+
+# По-чатовый лимит Telegram касается только сообщений в чат; getChatMember и прочие
+# запросы с chat_id канала идут лишь через общее ведро, иначе проверки подписки
+# всех пользователей одного канала выстраиваются в очередь 1 запрос/сек
+_CHAT_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+
+_stats = {
+    "requests": 0,
+    "throttled": 0,       # запросов, которым пришлось ждать токен
+    "wait_time": 0.0,     # суммарное ожидание, сек
+    "retry_after": 0,     # полученных RetryAfter (429)
+    "dropped": 0,         # низкоприоритетных запросов, отброшенных после 429
+}
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity за раз"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до следующего токена (0 — можно сейчас)"""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    Планировщик исходящих запросов к Bot API: общее и по-чатовые ведра токенов,
+    два уровня приоритета и автоматическое ожидание при RetryAfter.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(config.API_GLOBAL_RATE, config.API_GLOBAL_RATE)
+        self._chats = {}  # {chat_id: TokenBucket}
+        self._high_waiting = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > config.API_CHAT_BUCKETS_MAX:
+                # Удаляем полные ведра — они эквивалентны новым
+                now = time.monotonic()
+                for key in [k for k, b in self._chats.items() if b.delay(now) == 0 and b.tokens >= b.capacity]:
+                    del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(config.API_CHAT_RATE, config.API_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id, priority: str):
+        started = time.monotonic()
+        waited = False
+        if priority == PRIORITY_HIGH:
+            self._high_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                delay = self._global.delay(now)
+                if chat_id is not None:
+                    delay = max(delay, self._chat_bucket(chat_id).delay(now))
+                # Низкий приоритет уступает, пока ждут важные запросы
+                if priority == PRIORITY_LOW and self._high_waiting and delay == 0:
+                    delay = 0.05
+                if delay <= 0:
+                    break
+                waited = True
+                await asyncio.sleep(delay)
+            self._global.consume()
+            if chat_id is not None:
+                self._chat_bucket(chat_id).consume()
+        finally:
+            if priority == PRIORITY_HIGH:
+                self._high_waiting -= 1
+        if waited:
+            _stats["throttled"] += 1
+            _stats["wait_time"] += time.monotonic() - started
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id") if endpoint.startswith(_CHAT_ENDPOINT_PREFIXES) else None
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_HIGH)
+
+        for attempt in range(config.API_MAX_RETRIES + 1):
+            await self._acquire(chat_id, priority)
+            _stats["requests"] += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                _stats["retry_after"] += 1
+                retry_after = float(e.retry_after)
+                logger.warning(f"RetryAfter {retry_after} сек для {endpoint} (чат {chat_id})")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(retry_after)
+                else:
+                    self._global.block(retry_after)
+                # Устаревшую правку прогресса повторять незачем — придет более свежая
+                if priority == PRIORITY_LOW or attempt == config.API_MAX_RETRIES:
+                    if priority == PRIORITY_LOW:
+                        _stats["dropped"] += 1
+                    raise
+
+
+def get_stats() -> dict:
+    throttled = _stats["throttled"]
+    return {
+        **_stats,
+        "avg_wait": (_stats["wait_time"] / throttled) if throttled else 0,
+    }
@@ -0,0 +1,141 @@
+import sqlite3
+import logging
+import threading
+import config
+
+logger = logging.getLogger(__name__)
+
+# Таблицы: имя -> (колонки, первичный ключ)
+TABLES = {
+    "download_counts": (("user_id", "date", "count"), ("user_id",)),
+    "user_activity": (("user_id", "first_seen", "last_seen", "total_downloads", "subscribed"), ("user_id",)),
+    "daily_downloads": (("date", "count"), ("date",)),
+    "daily_active": (("date", "count"), ("date",)),
+    "subscriptions": (("user_id", "channel", "is_member", "fresh_until"), ("user_id", "channel")),
+    "file_ids": (("media_key", "file_id"), ("media_key",)),
+    "quality_choices": (("site", "quality", "count"), ("site", "quality")),
+}
+
+_pending = {}    # {(таблица, ключ): строка или None для удаления} — последние значения ждут записи
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_stop = threading.Event()
+_writer = None
+_stats = {"writes": 0, "batches": 0, "errors": 0}
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(config.STORAGE_PATH, timeout=30)
+    # WAL: чтение не блокируется записью, запись дешевле
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init():
+    """Создать таблицы и запустить фоновую запись"""
+    global _writer
+    conn = _connect()
+    with conn:
+        for table, (columns, key) in TABLES.items():
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)}, PRIMARY KEY ({', '.join(key)}))"
+            )
+    conn.close()
+
+    if _writer is None:
+        _stop.clear()
+        _writer = threading.Thread(target=_writer_loop, name="storage-writer", daemon=True)
+        _writer.start()
+
+
+def load(table: str, where: str = "", params: tuple = ()) -> list[tuple]:
+    """Прочитать строки таблицы (используется при старте для прогрева памяти)"""
+    conn = _connect()
+    try:
+        columns = ", ".join(TABLES[table][0])
+        return conn.execute(f"SELECT {columns} FROM {table} {where}", params).fetchall()
+    finally:
+        conn.close()
+
+
+def put(table: str, row: tuple):
+    """
+    Поставить строку в очередь на запись. Не блокирует: повторные изменения
+    той же строки до сброса схлопываются в одну запись.
+    """
+    columns, key_columns = TABLES[table]
+    key = tuple(row[columns.index(c)] for c in key_columns)
+    with _lock:
+        _pending[(table, key)] = row
+        size = len(_pending)
+    if size >= config.STORAGE_BATCH_SIZE:
+        _wakeup.set()
+
+
+def delete(table: str, key: tuple):
+    with _lock:
+        _pending[(table, key)] = None
+
+
+def flush(conn: sqlite3.Connection = None):
+    """Записать накопленные изменения одной транзакцией"""
+    with _lock:
+        if not _pending:
+            return
+        batch = dict(_pending)
+        _pending.clear()
+
+    own_conn = conn is None
+    if own_conn:
+        conn = _connect()
+    try:
+        with conn:
+            for (table, key), row in batch.items():
+                columns, key_columns = TABLES[table]
+                if row is None:
+                    condition = " AND ".join(f"{c} = ?" for c in key_columns)
+                    conn.execute(f"DELETE FROM {table} WHERE {condition}", key)
+                else:
+                    placeholders = ", ".join("?" for _ in columns)
+                    conn.execute(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", row)
+        _stats["writes"] += len(batch)
+        _stats["batches"] += 1
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.error(f"Ошибка записи состояния в {config.STORAGE_PATH}: {e}")
+        # Возвращаем изменения обратно, если их не перезаписали более новые
+        with _lock:
+            for item_key, row in batch.items():
+                _pending.setdefault(item_key, row)
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def _writer_loop():
+    conn = _connect()
+    try:
+        while not _stop.is_set():
+            _wakeup.wait(config.STORAGE_FLUSH_INTERVAL)
+            _wakeup.clear()
+            flush(conn)
+        flush(conn)
+    finally:
+        conn.close()
+
+
+def close():
+    """Остановить фоновую запись, сбросив все накопленное"""
+    global _writer
+    if _writer is not None:
+        _stop.set()
+        _wakeup.set()
+        _writer.join(timeout=10)
+        _writer = None
+
+
+def get_stats() -> dict:
+    with _lock:
+        pending = len(_pending)
+    return {"pending": pending, **_stats}
@@ -0,0 +1,126 @@
+import os
+import logging
+import ffmpeg
+import config
+
+logger = logging.getLogger(__name__)
+
+# Кодеки, которые Telegram показывает в плеере без перекодирования
+COMPATIBLE_VIDEO_CODECS = ("h264",)
+COMPATIBLE_AUDIO_CODECS = ("aac", "mp3")
+
+
+def lower_priority():
+    """Инициализатор процессов пула: перекодирование не должно отнимать CPU у скачиваний и бота"""
+    try:
+        os.nice(config.TRANSCODE_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def _probe(path: str) -> dict:
+    info = ffmpeg.probe(path, cmd=config.FFPROBE_PATH)
+    video = next((s for s in info["streams"] if s.get("codec_type") == "video"), None)
+    audio = next((s for s in info["streams"] if s.get("codec_type") == "audio"), None)
+    return {
+        "duration": float(info["format"].get("duration") or 0),
+        "format_name": info["format"].get("format_name", ""),
+        "video": video,
+        "audio": audio,
+    }
+
+
+def _is_compatible(media: dict) -> bool:
+    video, audio = media["video"], media["audio"]
+    if not video or video.get("codec_name") not in COMPATIBLE_VIDEO_CODECS:
+        return False
+    return audio is None or audio.get("codec_name") in COMPATIBLE_AUDIO_CODECS
+
+
+def _remux(path: str, out_path: str):
+    """Быстрый путь: смена контейнера на mp4 без перекодирования"""
+    (
+        ffmpeg.input(path)
+        .output(out_path, c="copy", movflags="+faststart")
+        .overwrite_output()
+        .run(cmd=config.FFMPEG_PATH, quiet=True)
+    )
+
+
+def _transcode(path: str, out_path: str, media: dict, limit: int, factor: float):
+    # Битрейт под бюджет: размер * 8 / длительность, с запасом на контейнер
+    total_bitrate = limit * 8 / media["duration"] * factor
+    audio_bitrate = config.TRANSCODE_AUDIO_BITRATE if media["audio"] else 0
+    video_bitrate = int(total_bitrate - audio_bitrate)
+    if video_bitrate < config.TRANSCODE_MIN_VIDEO_BITRATE:
+        raise Exception("Видео слишком длинное, чтобы сжать его до лимита")
+
+    source = ffmpeg.input(path)
+    video = source.video
+    # При низком битрейте уменьшаем разрешение — так картинка лучше, чем с артефактами
+    height = int(media["video"].get("height") or 0)
+    for min_bitrate, target_height in ((1_500_000, 720), (800_000, 480), (0, 360)):
+        if video_bitrate >= min_bitrate:
+            break
+    if height > target_height:
+        video = video.filter("scale", -2, target_height)
+
+    streams = [video, source.audio] if media["audio"] else [video]
+    options = {
+        "vcodec": "libx264",
+        "preset": config.TRANSCODE_PRESET,
+        "b:v": video_bitrate,
+        "maxrate": video_bitrate,
+        "bufsize": video_bitrate * 2,
+        "movflags": "+faststart",
+        "threads": config.TRANSCODE_THREADS,
+    }
+    if media["audio"]:
+        options.update({"acodec": "aac", "b:a": audio_bitrate})
+    (
+        ffmpeg.output(*streams, out_path, **options)
+        .overwrite_output()
+        .run(cmd=config.FFMPEG_PATH, quiet=True)
+    )
+
+
+def fit_to_limit(path: str, limit: int) -> str:
+    """
+    Подогнать файл под лимит размера. Возвращает путь к итоговому файлу
+    (исходный удаляется, если был создан новый).
+    """
+    size = os.path.getsize(path)
+    base = os.path.splitext(path)[0]
+    # Обычный случай — mp4 в пределах лимита: ffprobe не нужен
+    if size <= limit and path.endswith(".mp4"):
+        return path
+    try:
+        media = _probe(path)
+    except Exception as e:
+        if size <= limit:
+            logger.warning(f"Не удалось прочитать {path} через ffprobe, отправляем как есть: {e}")
+            return path
+        raise
+
+    if size <= limit:
+        # Влезает: при необходимости только меняем контейнер на mp4
+        if path.endswith(".mp4") or not _is_compatible(media):
+            return path
+        out_path = base + "_remux.mp4"
+        _remux(path, out_path)
+    else:
+        if not media["video"] or not media["duration"]:
+            raise Exception("Не удалось определить параметры видео для сжатия")
+        out_path = base + "_fit.mp4"
+        # Однопроходное кодирование может немного превысить битрейт — вторая попытка с запасом
+        for factor in (0.95, 0.85):
+            logger.info(f"Сжимаю {path} ({size // (1024 * 1024)}MB) до {limit // (1024 * 1024)}MB")
+            _transcode(path, out_path, media, limit, factor)
+            if os.path.getsize(out_path) <= limit:
+                break
+        else:
+            os.remove(out_path)
+            raise Exception("Не удалось сжать видео до допустимого размера")
+
+    os.remove(path)
+    return out_path
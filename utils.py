@@ -1,476 +1,1795 @@
-import yt_dlp
-import os
-import time
-import uuid
-import logging
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-import config
-
-logger = logging.getLogger(__name__)
-
-URL_CACHE = {}
-_subscription_cache = {}
-_download_counts = {}  # {user_id: {"count": int, "date": str}}
-_analytics = {
-    "total_users": set(),
-    "subscribed_users": set(),
-    "daily_downloads": {},  # {date: count}
-    "user_activity": {},    # {user_id: {"first_seen": date, "last_seen": date, "total_downloads": int}}
-}
-
-# Система контроля нагрузки
-_active_downloads = set()  # Множество активных скачиваний
-
-def can_start_download(user_id: int) -> bool:
-    """Проверить, можно ли начать новое скачивание"""
-    import config
-    return len(_active_downloads) < config.MAX_CONCURRENT_DOWNLOADS
-
-def start_download(user_id: int) -> bool:
-    """Начать отслеживание скачивания"""
-    if can_start_download(user_id):
-        _active_downloads.add(user_id)
-        return True
-    return False
-
-def finish_download(user_id: int):
-    """Завершить отслеживание скачивания"""
-    _active_downloads.discard(user_id)
-
-def get_system_load() -> dict:
-    """Получить информацию о нагрузке системы"""
-    return {
-        "active_downloads": len(_active_downloads),
-        "max_concurrent": config.MAX_CONCURRENT_DOWNLOADS,
-        "load_percentage": (len(_active_downloads) / config.MAX_CONCURRENT_DOWNLOADS) * 100
-    }
-
-
-# --- аналитика ---
-def track_user_activity(user_id: int, action: str = "visit"):
-    """Отслеживать активность пользователя"""
-    today = _get_today_date()
-    
-    # Добавляем пользователя в общую статистику
-    _analytics["total_users"].add(user_id)
-    
-    # Обновляем активность пользователя
-    if user_id not in _analytics["user_activity"]:
-        _analytics["user_activity"][user_id] = {
-            "first_seen": today,
-            "last_seen": today,
-            "total_downloads": 0,
-            "subscription_status": False
-        }
-    else:
-        _analytics["user_activity"][user_id]["last_seen"] = today
-    
-    # Обновляем ежедневную статистику
-    if today not in _analytics["daily_downloads"]:
-        _analytics["daily_downloads"][today] = 0
-
-def track_subscription(user_id: int, is_subscribed: bool):
-    """Отслеживать статус подписки"""
-    if is_subscribed:
-        _analytics["subscribed_users"].add(user_id)
-        if user_id in _analytics["user_activity"]:
-            _analytics["user_activity"][user_id]["subscription_status"] = True
-    else:
-        _analytics["subscribed_users"].discard(user_id)
-        if user_id in _analytics["user_activity"]:
-            _analytics["user_activity"][user_id]["subscription_status"] = False
-
-def track_download(user_id: int):
-    """Отслеживать скачивание"""
-    today = _get_today_date()
-    
-    # Увеличиваем счетчик ежедневных скачиваний
-    if today not in _analytics["daily_downloads"]:
-        _analytics["daily_downloads"][today] = 0
-    _analytics["daily_downloads"][today] += 1
-    
-    # Обновляем статистику пользователя
-    if user_id in _analytics["user_activity"]:
-        _analytics["user_activity"][user_id]["total_downloads"] += 1
-
-def get_analytics_summary():
-    """Получить сводку аналитики"""
-    today = _get_today_date()
-    
-    # Статистика пользователей
-    total_users = len(_analytics["total_users"])
-    subscribed_users = len(_analytics["subscribed_users"])
-    subscription_rate = (subscribed_users / total_users * 100) if total_users > 0 else 0
-    
-    # Статистика скачиваний
-    today_downloads = _analytics["daily_downloads"].get(today, 0)
-    total_downloads = sum(_analytics["daily_downloads"].values())
-    
-    # Активные пользователи (за последние 7 дней)
-    active_users = 0
-    for user_data in _analytics["user_activity"].values():
-        if user_data["last_seen"] == today:
-            active_users += 1
-    
-    return {
-        "total_users": total_users,
-        "subscribed_users": subscribed_users,
-        "subscription_rate": round(subscription_rate, 1),
-        "today_downloads": today_downloads,
-        "total_downloads": total_downloads,
-        "active_users_today": active_users,
-        "daily_stats": dict(_analytics["daily_downloads"])
-    }
-
-def get_user_stats(user_id: int):
-    """Получить статистику конкретного пользователя"""
-    if user_id not in _analytics["user_activity"]:
-        return None
-    
-    user_data = _analytics["user_activity"][user_id]
-    return {
-        "user_id": user_id,
-        "first_seen": user_data["first_seen"],
-        "last_seen": user_data["last_seen"],
-        "total_downloads": user_data["total_downloads"],
-        "is_subscribed": user_data["subscription_status"]
-    }
-
-
-# --- ограничения скачиваний ---
-def _get_today_date():
-    """Получить текущую дату в формате YYYY-MM-DD"""
-    from datetime import datetime
-    return datetime.now().strftime("%Y-%m-%d")
-
-def _reset_daily_counts():
-    """Сбросить счетчики скачиваний для всех пользователей"""
-    today = _get_today_date()
-    for user_id in list(_download_counts.keys()):
-        if _download_counts[user_id]["date"] != today:
-            del _download_counts[user_id]
-
-def get_user_download_count(user_id: int) -> int:
-    """Получить количество скачиваний пользователя за сегодня"""
-    _reset_daily_counts()
-    today = _get_today_date()
-    
-    if user_id not in _download_counts:
-        _download_counts[user_id] = {"count": 0, "date": today}
-    elif _download_counts[user_id]["date"] != today:
-        _download_counts[user_id] = {"count": 0, "date": today}
-    
-    return _download_counts[user_id]["count"]
-
-def increment_download_count(user_id: int) -> int:
-    """Увеличить счетчик скачиваний пользователя"""
-    _reset_daily_counts()
-    today = _get_today_date()
-    
-    if user_id not in _download_counts:
-        _download_counts[user_id] = {"count": 1, "date": today}
-    elif _download_counts[user_id]["date"] != today:
-        _download_counts[user_id] = {"count": 1, "date": today}
-    else:
-        _download_counts[user_id]["count"] += 1
-    
-    # Отслеживаем скачивание в аналитике
-    track_download(user_id)
-    
-    return _download_counts[user_id]["count"]
-
-def can_user_download(user_id: int, max_downloads: int = 5) -> bool:
-    """Проверить, может ли пользователь скачать видео"""
-    return get_user_download_count(user_id) < max_downloads
-
-def get_remaining_downloads(user_id: int, max_downloads: int = 5) -> int:
-    """Получить количество оставшихся скачиваний"""
-    return max(0, max_downloads - get_user_download_count(user_id))
-
-
-# --- кеш подписки ---
-def _check_cache(user_id: int):
-    if user_id in _subscription_cache:
-        is_sub, ts = _subscription_cache[user_id]
-        if time.time() - ts < config.CACHE_TIMEOUT:
-            return is_sub
-    return None
-
-
-def _set_cache(user_id: int, is_sub: bool):
-    _subscription_cache[user_id] = (is_sub, time.time())
-
-
-async def check_subscription(user_id: int, context) -> bool:
-    """
-    Проверка подписки на каналы из config.CHANNELS
-    """
-    cached = _check_cache(user_id)
-    if cached is not None:
-        return cached
-
-    try:
-        for ch in config.CHANNELS:
-            member = await context.bot.get_chat_member(ch, user_id)
-            if member.status not in ["member", "administrator", "creator"]:
-                _set_cache(user_id, False)
-                track_subscription(user_id, False)
-                return False
-        _set_cache(user_id, True)
-        track_subscription(user_id, True)
-        return True
-    except Exception as e:
-        logger.warning(f"Ошибка проверки подписки: {e}")
-        _set_cache(user_id, False)
-        track_subscription(user_id, False)
-        return False
-
-
-# --- нормализация ссылок ---
-def normalize_video_url(url: str) -> str | None:
-    if not url:
-        return None
-    url = url.strip()
-    lower = url.lower()
-
-    if "youtube.com/shorts/" in lower:
-        video_id = url.split("shorts/")[-1].split("?")[0].split("/")[0]
-        return f"https://www.youtube.com/watch?v={video_id}"
-
-    if "youtu.be/" in lower:
-        video_id = url.split("youtu.be/")[-1].split("?")[0].split("/")[0]
-        return f"https://www.youtube.com/watch?v={video_id}"
-
-    if "youtube.com/embed/" in lower:
-        video_id = url.split("embed/")[-1].split("?")[0].split("/")[0]
-        return f"https://www.youtube.com/watch?v={video_id}"
-
-    if "youtube.com/watch" in lower:
-        return url.split("&")[0]
-
-    if "tiktok.com" in lower:
-        return url.split("?")[0]
-
-    if "instagram.com" in lower and any(x in lower for x in ["/reel/", "/p/", "/tv/"]):
-        return url.split("?")[0]
-
-    if any(x in lower for x in ["vk.com", "vimeo.com", "dailymotion.com"]):
-        return url.split("?")[0]
-
-    return None
-
-
-# --- доступные качества ---
-def get_available_qualities(url: str) -> list[int]:
-    """
-    Получить список доступных качеств для видео
-    """
-    try:
-        # Создаем временный экземпляр yt-dlp для получения информации
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "extract_flat": False,
-            "listformats": True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if not info or 'formats' not in info:
-                # Если не удалось получить информацию, возвращаем стандартные качества
-                return [480, 720, 1080]
-            
-            # Извлекаем доступные разрешения
-            available_heights = set()
-            for fmt in info['formats']:
-                if fmt.get('height') and fmt.get('vcodec') != 'none':
-                    available_heights.add(fmt['height'])
-            
-            # Сортируем и фильтруем качества
-            heights = sorted([h for h in available_heights if h >= 360], reverse=True)
-            
-            # Возвращаем до 3 лучших качеств
-            if not heights:
-                return [480, 720, 1080]  # Fallback
-            
-            # Выбираем лучшие доступные качества
-            selected = []
-            for target in [1080, 720, 480]:
-                for height in heights:
-                    if height >= target and target not in selected:
-                        selected.append(target)
-                        break
-            
-            return selected if selected else [heights[0]] if heights else [720]
-            
-    except Exception as e:
-        logger.warning(f"Не удалось получить доступные качества: {e}")
-        # Возвращаем стандартные качества в случае ошибки
-        return [480, 720, 1080]
-
-
-# --- скачивание видео ---
-def download_video(url: str, quality: str, user_id: int = None) -> str:
-    try:
-        height = int(quality)
-    except Exception:
-        height = 720
-
-    # Проверяем нагрузку системы
-    if user_id and not can_start_download(user_id):
-        raise Exception("Система перегружена. Попробуйте позже.")
-
-    # Начинаем отслеживание скачивания
-    if user_id:
-        start_download(user_id)
-
-    os.makedirs("downloads", exist_ok=True)
-
-    ydl_opts = {
-        # Улучшенная логика выбора качества - сначала ищем точное качество, потом лучшее доступное
-        "format": f"bestvideo[height<={height}]+bestaudio/best[height<={height}]/bestvideo+bestaudio/best",
-        "outtmpl": "downloads/%(id)s_%(height)sp.%(ext)s",
-        "merge_output_format": "mp4",
-        "ffmpeg_location": config.FFMPEG_PATH,
-        "noplaylist": True,
-        "quiet": True,
-        # Увеличиваем лимит размера файла для лучшего качества
-        "max_filesize": config.MAX_FILE_SIZE * 2,  # Удваиваем лимит для качества
-        "http_headers": {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Accept-Encoding": "gzip, deflate",
-            "DNT": "1",
-            "Connection": "keep-alive",
-            "Upgrade-Insecure-Requests": "1",
-        },
-        "geo_bypass": True,
-        "nocheckcertificate": True,
-        "retries": 5,
-        "socket_timeout": 60,
-        "extractor_retries": 3,
-        "fragment_retries": 5,
-        "skip_unavailable_fragments": True,
-        "keep_fragments": True,
-        "extract_flat": False,
-        "writethumbnail": False,
-        "writeinfojson": False,
-        "ignoreerrors": False,
-        "no_color": True,
-        "prefer_insecure": False,
-        "legacy_server_connect": True,
-        # Дополнительные настройки для лучшего качества
-        "format_sort": ["res", "ext:mp4:m4a", "proto:https", "proto:http"],
-        "format_sort_force": True,
-    }
-
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            if not info:
-                raise Exception("Не удалось получить информацию о видео")
-                
-            filename = ydl.prepare_filename(info)
-            mp4_name = os.path.splitext(filename)[0] + ".mp4"
-            
-            # Проверяем, какой файл был создан
-            if os.path.exists(mp4_name):
-                if user_id:
-                    finish_download(user_id)
-                return mp4_name
-            elif os.path.exists(filename):
-                if user_id:
-                    finish_download(user_id)
-                return filename
-            else:
-                if user_id:
-                    finish_download(user_id)
-                raise Exception("Файл не был создан")
-                
-    except Exception as e:
-        logger.error(f"Ошибка скачивания видео: {e}")
-        
-        # Попробуем альтернативный метод с другими настройками
-        logger.info("Пробуем альтернативный метод скачивания...")
-        try:
-            alt_opts = ydl_opts.copy()
-            alt_opts.update({
-                # Более агрессивная стратегия для альтернативного метода
-                "format": f"bestvideo[height<={height}]+bestaudio/best[height<={height}]/best",
-                "extract_flat": False,
-                "writethumbnail": False,
-                "writeinfojson": False,
-                "ignoreerrors": True,
-                "no_color": True,
-                "prefer_insecure": True,
-                "legacy_server_connect": False,
-                # Дополнительные настройки для альтернативного метода
-                "format_sort": ["res", "ext:mp4:m4a", "proto:https", "proto:http"],
-                "format_sort_force": True,
-            })
-            
-            with yt_dlp.YoutubeDL(alt_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                if not info:
-                    raise Exception("Не удалось получить информацию о видео (альтернативный метод)")
-                    
-                filename = ydl.prepare_filename(info)
-                mp4_name = os.path.splitext(filename)[0] + ".mp4"
-                
-                if os.path.exists(mp4_name):
-                    if user_id:
-                        finish_download(user_id)
-                    return mp4_name
-                elif os.path.exists(filename):
-                    if user_id:
-                        finish_download(user_id)
-                    return filename
-                else:
-                    if user_id:
-                        finish_download(user_id)
-                    raise Exception("Файл не был создан (альтернативный метод)")
-                    
-        except Exception as alt_e:
-            logger.error(f"Альтернативный метод также не сработал: {alt_e}")
-            if user_id:
-                finish_download(user_id)
-            raise e
-    except Exception as e:
-        if user_id:
-            finish_download(user_id)
-        raise e
-
-
-# --- клавиатуры ---
-def subscription_keyboard():
-    buttons = [
-        [InlineKeyboardButton(f"🔔 {ch}", url=f"https://t.me/{ch.replace('@','')}")]
-        for ch in config.CHANNELS
-    ]
-    buttons.append([InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")])
-    return InlineKeyboardMarkup(buttons)
-
-
-def quality_keyboard(url: str, user_id: int):
-    video_id = str(uuid.uuid4())[:8]
-    URL_CACHE[video_id] = url
-    qualities = get_available_qualities(url)
-    
-    # Получаем информацию о лимитах
-    remaining = get_remaining_downloads(user_id, config.MAX_DAILY_DOWNLOADS)
-    
-    # Создаем кнопки в одну строку
-    buttons = []
-    row = []
-    for q in qualities:
-        # Добавляем эмодзи в зависимости от качества
-        emoji = "🔥" if q >= 1080 else "⭐" if q >= 720 else "📹"
-        row.append(InlineKeyboardButton(f"{emoji} {q}p", callback_data=f"quality_{q}_{video_id}"))
-    buttons.append(row)
-    
-    return InlineKeyboardMarkup(buttons), remaining
-
-
-def pop_cached_url(video_id: str):
-    return URL_CACHE.get(video_id)
+import yt_dlp
+import os
+import re
+import copy
+import time
+import glob
+import shutil
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from yt_dlp.utils import DownloadCancelled
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from cache import BoundedCache
+import config
+import storage
+import progress
+import admission
+import transcode
+import jobqueue
+import metrics
+
+logger = logging.getLogger(__name__)
+
+URL_CACHE = BoundedCache("ссылки", config.URL_CACHE_SIZE, config.URL_CACHE_TTL)  # {video_id: url}
+# {(user_id, channel): (is_member, fresh_until)}; устаревшие записи держим дольше —
+# они нужны как запасной ответ при ошибках API
+_subscription_cache = BoundedCache("подписки", config.SUBSCRIPTION_CACHE_SIZE, config.CHAT_MEMBER_EVENT_TTL)
+# {user_id: [день, подтверждено, зарезервировано]}
+_download_counts = BoundedCache("лимиты", config.DOWNLOAD_COUNTS_CACHE_SIZE, 24 * 3600)
+_analytics = {
+    "subscribed_users": set(),
+    "total_downloads": 0,   # накопительный итог, чтобы не суммировать дни
+    # Последние config.ANALYTICS_DAYS дней: {date: [скачиваний, активные]}.
+    # Для текущего дня активные — множество id, для закрытых дней — только их число
+    "days": OrderedDict(),
+    "user_activity": {},    # {user_id: {"first_seen": date, "last_seen": date, "total_downloads": int}}
+    "quality_choices": {},  # {сайт: {качество: сколько раз выбрано}}
+}
+
+# --- очередь скачиваний ---
+# Все операции выполняются в event loop, поэтому проверка и захват слота атомарны
+_running_jobs = {}          # {job_id: {"user_id": int, "started": float, "cost": int}}
+_waiting_jobs = deque()     # задания в порядке поступления
+_recent_durations = deque(maxlen=20)  # длительность последних скачиваний, сек
+_recent_waits = deque(maxlen=20)      # время ожидания в очереди, сек
+
+
+def _max_concurrent() -> int:
+    """Сколько заданий выполняется одновременно: в режиме queue их выполняют внешние воркеры"""
+    if config.DOWNLOAD_BACKEND == "queue":
+        return config.JOB_QUEUE_INFLIGHT
+    return admission.get_limit()
+
+
+def _can_start(cost: int) -> bool:
+    """Есть ли слот и хватит ли памяти на задание с оценкой cost (память считаем только для своих скачиваний)"""
+    if len(_running_jobs) >= _max_concurrent():
+        return False
+    return config.DOWNLOAD_BACKEND == "queue" or admission.fits(cost, len(_running_jobs))
+
+
+def _user_job_count(user_id: int) -> int:
+    running = sum(1 for job in _running_jobs.values() if job["user_id"] == user_id)
+    return running + sum(1 for job in _waiting_jobs if job["user_id"] == user_id)
+
+
+def _estimate_wait(position: int) -> float:
+    """Оценка ожидания для позиции в очереди (1 — следующая)"""
+    avg = sum(_recent_durations) / len(_recent_durations) if _recent_durations else 60
+    limit = _max_concurrent()
+    rounds = (position + limit - 1) // limit
+    return avg * rounds
+
+
+async def acquire_download_slot(user_id: int, on_position=None, cost: int = 0) -> str:
+    """
+    Дождаться свободного слота для скачивания. on_position(position, eta) —
+    корутина, которая вызывается при изменении места в очереди (0 — скачивание началось).
+    cost — оценка памяти задания (estimate_job_cost).
+    """
+    if user_id and _user_job_count(user_id) >= config.MAX_USER_DOWNLOADS:
+        raise Exception(f"У вас уже {config.MAX_USER_DOWNLOADS} скачивания в работе. Дождитесь их завершения.")
+
+    job = {
+        "id": str(uuid.uuid4())[:8],
+        "user_id": user_id,
+        "enqueued": time.time(),
+        "future": asyncio.get_running_loop().create_future(),
+        "on_position": on_position,
+        "position": None,
+        "cost": cost,
+        "skipped": 0,  # сколько раз более легкие задания обошли это из-за нехватки памяти
+    }
+    if not _waiting_jobs and _can_start(cost):
+        _start_job(job)
+        return job["id"]
+
+    if len(_waiting_jobs) >= config.MAX_QUEUE_SIZE:
+        raise Exception("Очередь скачиваний переполнена. Попробуйте позже.")
+
+    _waiting_jobs.append(job)
+    # Первому в очереди может не хватать памяти, а этому заданию — хватить
+    _dispatch()
+    # Слот, занятый невыбранной предзагрузкой, отдаем этому заданию, если _dispatch его еще не запустил
+    if not job["future"].done():
+        _preempt_prefetch()
+    try:
+        await job["future"]
+    except asyncio.CancelledError:
+        if job in _waiting_jobs:
+            _waiting_jobs.remove(job)
+            _notify_positions()
+        else:
+            # слот уже был выдан — возвращаем его
+            release_download_slot(job["id"])
+        raise
+    return job["id"]
+
+
+def release_download_slot(job_id: str):
+    """Освободить слот и передать его следующему заданию"""
+    job = _running_jobs.pop(job_id, None)
+    if job is not None:
+        _recent_durations.append(time.time() - job["started"])
+        if config.DOWNLOAD_BACKEND != "queue":
+            admission.release(job["cost"])
+    _dispatch()
+
+
+def _start_job(job: dict):
+    now = time.time()
+    _running_jobs[job["id"]] = {"user_id": job["user_id"], "started": now, "cost": job["cost"]}
+    _recent_waits.append(now - job["enqueued"])
+    if config.DOWNLOAD_BACKEND != "queue":
+        admission.reserve(job["cost"])
+    if job["position"] is not None and job["on_position"]:
+        asyncio.create_task(job["on_position"](0, 0))
+    if not job["future"].done():
+        job["future"].set_result(job["id"])
+
+
+def _dispatch():
+    """
+    Выдать свободные слоты: сначала пользователям, у которых меньше всего активных скачиваний.
+    Если на первое задание не хватает памяти, слот получает следующее, которое в нее влезает,
+    но не больше ADMISSION_MAX_SKIPS раз — дальше слоты ждут первое, чтобы тяжелые не голодали.
+    """
+    while _waiting_jobs and len(_running_jobs) < _max_concurrent():
+        running_by_user = {}
+        for running in _running_jobs.values():
+            running_by_user[running["user_id"]] = running_by_user.get(running["user_id"], 0) + 1
+        # sorted() устойчива — при равенстве сохраняется порядок FIFO
+        ordered = sorted(_waiting_jobs, key=lambda j: running_by_user.get(j["user_id"], 0))
+        head = ordered[0]
+        if _can_start(head["cost"]):
+            job = head
+        elif head["skipped"] < config.ADMISSION_MAX_SKIPS:
+            job = next((j for j in ordered[1:] if _can_start(j["cost"])), None)
+            if job is not None:
+                head["skipped"] += 1
+        else:
+            job = None
+        if job is None:
+            break
+        _waiting_jobs.remove(job)
+        _start_job(job)
+    _notify_positions()
+
+
+def _notify_positions():
+    for position, job in enumerate(_waiting_jobs, start=1):
+        if job["position"] != position:
+            job["position"] = position
+            if job["on_position"]:
+                asyncio.create_task(job["on_position"](position, _estimate_wait(position)))
+
+
+def get_system_load() -> dict:
+    """Получить информацию о нагрузке системы"""
+    now = time.time()
+    limit = _max_concurrent()
+    return {
+        "backend": config.DOWNLOAD_BACKEND,
+        "active_downloads": len(_running_jobs),
+        "max_concurrent": limit,
+        "load_percentage": (len(_running_jobs) / limit) * 100,
+        "queue_depth": len(_waiting_jobs),
+        "max_queue": config.MAX_QUEUE_SIZE,
+        "longest_wait": (now - _waiting_jobs[0]["enqueued"]) if _waiting_jobs else 0,
+        "avg_wait": (sum(_recent_waits) / len(_recent_waits)) if _recent_waits else 0,
+        "avg_duration": (sum(_recent_durations) / len(_recent_durations)) if _recent_durations else 0,
+    }
+
+
+# --- пул скачиваний ---
+_download_executor = None
+_metadata_executor = None
+_transcode_executor = None
+
+
+def get_download_executor():
+    """Получить (или создать) пул для скачиваний"""
+    global _download_executor
+    if _download_executor is None:
+        workers = max(1, config.DOWNLOAD_WORKERS)
+        if config.ADAPTIVE_ADMISSION:
+            # Потоков должно хватать на самый высокий лимит, иначе он упрется в пул
+            workers = max(workers, config.ADMISSION_MAX_CONCURRENT)
+        if config.DOWNLOAD_POOL_TYPE == "process":
+            _download_executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _download_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        logger.info(f"Пул скачиваний: {config.DOWNLOAD_POOL_TYPE}, воркеров: {workers}")
+    return _download_executor
+
+
+def get_metadata_executor():
+    """Пул потоков для получения метаданных (отдельно от скачиваний, чтобы не ждать их)"""
+    global _metadata_executor
+    if _metadata_executor is None:
+        _metadata_executor = ThreadPoolExecutor(max_workers=config.METADATA_WORKERS, thread_name_prefix="metadata")
+    return _metadata_executor
+
+
+def get_transcode_executor():
+    """Пул процессов ffmpeg с пониженным приоритетом, отдельно от скачиваний"""
+    global _transcode_executor
+    if _transcode_executor is None:
+        _transcode_executor = ProcessPoolExecutor(
+            max_workers=config.TRANSCODE_WORKERS, initializer=transcode.lower_priority
+        )
+    return _transcode_executor
+
+
+def shutdown_download_executor():
+    """Остановить пулы скачиваний, метаданных и перекодирования, отменив задачи в очереди"""
+    global _download_executor, _metadata_executor, _transcode_executor
+    if _transcode_executor is not None:
+        _transcode_executor.shutdown(wait=False, cancel_futures=True)
+        _transcode_executor = None
+    if _download_executor is not None:
+        _download_executor.shutdown(wait=False, cancel_futures=True)
+        _download_executor = None
+    if _metadata_executor is not None:
+        _metadata_executor.shutdown(wait=False, cancel_futures=True)
+        _metadata_executor = None
+
+
+async def run_download(url: str, quality: str, user_id: int = None, on_position=None, progress_key=None,
+                       prefetch: dict = None) -> str:
+    """
+    Скачать видео в пуле, не блокируя event loop, и подогнать под лимит (ENABLE_TRANSCODE).
+    Отмена корутины отменяет задачу, если она еще не начала выполняться.
+    prefetch — предзагрузка: только в свободный слот, прерывается через prefetch["abort"].
+    """
+    cost = estimate_job_cost(url, quality)
+    if prefetch is not None and (_waiting_jobs or not _can_start(cost)):
+        raise Exception("Нет свободных слотов для предзагрузки")
+    # Очередь ведется в основном процессе: в пуле процессов
+    # состояние модуля у каждого воркера свое
+    with metrics.timer("queue"):
+        job_id = await acquire_download_slot(user_id, on_position, cost)
+    if prefetch is not None:
+        prefetch["slot"] = job_id
+    # Место на диске закреплено за заданием и в паузах между попытками, когда слота у него нет
+    disk_id = job_id
+    try:
+        await reserve_disk(disk_id, _estimate_disk_need(url, quality))
+    except Exception:
+        release_download_slot(job_id)
+        raise
+
+    try:
+        if config.DOWNLOAD_BACKEND == "queue":
+            # Воркер сам подгоняет файл под лимит
+            with metrics.timer("download", backend="queue"):
+                file_path = await _run_queued_download(url, quality, progress_key)
+            release_disk(disk_id)
+            return file_path
+
+        # Прогресс доступен только в пуле потоков: из процесса хук не достучится до бота
+        hook = None
+        if progress_key is not None and config.DOWNLOAD_POOL_TYPE != "process":
+            hook = progress.make_download_hook(progress_key, quality)
+        if prefetch is not None:
+            hook = _make_abort_hook(prefetch["abort"], hook)
+
+        retry = {}
+        while True:
+            # Метаданные передаются явно: у процессов пула свой (пустой) кеш
+            future = get_download_executor().submit(download_video, url, quality, get_cached_info(url), hook, retry)
+            try:
+                with metrics.timer("download", backend="local"):
+                    file_path = await asyncio.wrap_future(future)
+                break
+            except RetryDownload as e:
+                retry = e.retry
+                if not e.delay:
+                    continue
+                delay = e.delay
+            # Пауза перед повтором (например, после 429) — без слота: он нужен другим
+            release_download_slot(job_id)
+            job_id = None
+            if prefetch is not None:
+                prefetch["slot"] = None
+            if progress_key is not None:
+                progress.report(progress_key, f"🔁 Повторю скачивание через {delay:g} сек...")
+            await _retry_pause(delay, prefetch["abort"] if prefetch is not None else None)
+            # Невыбранная предзагрузка занимает только свободный слот
+            if prefetch is not None and _prefetches.get(prefetch["key"]) is prefetch and (_waiting_jobs or not _can_start(cost)):
+                raise Exception("Нет свободных слотов для предзагрузки")
+            job_id = await acquire_download_slot(user_id, on_position, cost)
+            if prefetch is not None:
+                prefetch["slot"] = job_id
+    except BaseException:
+        release_disk(disk_id)
+        raise
+    finally:
+        release_download_slot(job_id)
+
+    # Слот скачивания свободен, а место на диске остается за заданием, пока файл сжимается:
+    # перекодирование пишет рядом второй файл
+    try:
+        if config.ENABLE_TRANSCODE:
+            file_path = await fit_video(file_path, progress_key)
+    finally:
+        release_disk(disk_id)
+    return file_path
+
+
+async def _retry_pause(delay: float, abort: threading.Event = None):
+    """Пауза перед повтором скачивания; предзагрузку, отмененную за это время, не повторяем"""
+    deadline = time.monotonic() + delay
+    while True:
+        if abort is not None and abort.is_set():
+            raise DownloadCancelled("Предзагрузка отменена")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, 1))
+
+
+async def _run_queued_download(url: str, quality: str, progress_key=None) -> str:
+    """
+    Поставить задание в общую очередь и дождаться, пока его выполнит worker.py.
+    Воркер сам подгоняет файл под лимит, прогресс передается через очередь.
+    """
+    loop = asyncio.get_running_loop()
+    job_id = await loop.run_in_executor(None, jobqueue.enqueue, url, quality, get_cached_info(url))
+    try:
+        while True:
+            await asyncio.sleep(config.JOB_POLL_INTERVAL)
+            job = await loop.run_in_executor(None, jobqueue.get, job_id)
+            if job is None:
+                raise Exception("Задание скачивания потеряно")
+            if job["status"] == "done":
+                return job["result"]
+            if job["status"] == "failed":
+                raise Exception(job["error"] or "Не удалось скачать видео")
+            if progress_key is not None and job["progress"]:
+                progress.report(progress_key, job["progress"])
+    except asyncio.CancelledError:
+        # Уже начатое задание доработает, а лишний файл уберет очистка папки
+        jobqueue.cancel(job_id)
+        raise
+
+
+# --- место на диске ---
+_disk_reservations = {}  # {job_id: байт} — место, обещанное идущим скачиваниям
+_janitor_task = None
+_janitor_stats = {"runs": 0, "deleted_files": 0, "deleted_bytes": 0, "last_run": None}
+
+
+def _estimate_disk_need(url: str, quality: str) -> int:
+    """Сколько места займет задание: видео + аудио до склейки и итоговый файл"""
+    info = get_cached_info(url)
+    size = None
+    if info:
+        try:
+            size = estimate_quality_size(info, int(quality))
+        except ValueError:
+            pass
+    size = min(size or get_download_cap(), get_download_cap())
+    return size * 2
+
+
+def _downloads_dir_usage() -> int:
+    total = 0
+    try:
+        with os.scandir(config.DOWNLOADS_DIR) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return total
+
+
+def _disk_free() -> int:
+    os.makedirs(config.DOWNLOADS_DIR, exist_ok=True)
+    return shutil.disk_usage(config.DOWNLOADS_DIR).free
+
+
+def _disk_fits(need: int, reserved: int) -> bool:
+    if _downloads_dir_usage() + reserved + need > config.DOWNLOADS_QUOTA:
+        return False
+    return _disk_free() - reserved - need >= config.MIN_FREE_DISK
+
+
+def _make_disk_room(need: int, reserved: int) -> bool:
+    """Хватит ли места; если нет — почистить брошенные файлы и проверить снова (сканирует папку, вне event loop)"""
+    if _disk_fits(need, reserved):
+        return True
+    cleanup_downloads(enforce_quota=True)
+    return _disk_fits(need, reserved)
+
+
+async def reserve_disk(job_id: str, need: int):
+    """Зарезервировать место под задание; если не хватает — сначала почистить брошенные файлы"""
+    # Резервируем до проверки: параллельные проверки уже видят это место занятым
+    reserved = sum(_disk_reservations.values())
+    _disk_reservations[job_id] = need
+    loop = asyncio.get_running_loop()
+    try:
+        fits = await loop.run_in_executor(None, _make_disk_room, need, reserved)
+    except BaseException:
+        release_disk(job_id)
+        raise
+    if not fits:
+        release_disk(job_id)
+        raise Exception("Недостаточно места на диске. Попробуйте позже.")
+
+
+def release_disk(job_id: str):
+    _disk_reservations.pop(job_id, None)
+
+
+def cleanup_downloads(enforce_quota: bool = False) -> int:
+    """
+    Удалить брошенные файлы из папки скачиваний: старше config.ORPHAN_FILE_AGE,
+    а при enforce_quota — и самые старые, пока папка не уложится в квоту.
+    Файлы, которые еще отправляются, не трогаем. Возвращает число удаленных файлов.
+    """
+    now = time.time()
+    busy = _inflight_prefixes()
+    files = []
+    try:
+        with os.scandir(config.DOWNLOADS_DIR) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.path not in _file_refs and not entry.name.startswith(busy):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return 0
+
+    files.sort()
+    usage = _downloads_dir_usage()
+    deleted = 0
+    for mtime, size, path in files:
+        orphaned = now - mtime > config.ORPHAN_FILE_AGE
+        # Для квоты не трогаем файлы, в которые только что писали — их качает активное задание
+        over_quota = enforce_quota and usage > config.DOWNLOADS_QUOTA and now - mtime > 60
+        if not (orphaned or over_quota):
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+            continue
+        usage -= size
+        deleted += 1
+        _janitor_stats["deleted_files"] += 1
+        _janitor_stats["deleted_bytes"] += size
+
+    _janitor_stats["runs"] += 1
+    _janitor_stats["last_run"] = now
+    if deleted:
+        logger.info(f"Очистка папки скачиваний: удалено файлов {deleted}")
+    return deleted
+
+
+def _inflight_prefixes() -> tuple:
+    """
+    Начала имен файлов идущих скачиваний. Их файлы еще пишутся, склеиваются, сжимаются
+    или ждут передачи из очереди, а mtime у них — с сервера, поэтому по возрасту их не судят.
+    """
+    prefixes = []
+    for job in list(_inflight.values()):
+        info = get_cached_info(job["url"])
+        video_id = (info or {}).get("id") or job["key"][1]
+        prefixes.append(f"{video_id}_{_requested_height(job['key'][-1])}_")
+    return tuple(prefixes)
+
+
+async def _janitor_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, cleanup_downloads)
+        except Exception as e:
+            logger.error(f"Ошибка очистки папки скачиваний: {e}")
+        await asyncio.sleep(config.CLEANUP_INTERVAL)
+
+
+def start_janitor():
+    """Запустить периодическую очистку (первый проход — сразу, убирает остатки прошлого запуска)"""
+    global _janitor_task
+    if _janitor_task is None:
+        _janitor_task = asyncio.create_task(_janitor_loop())
+
+
+def stop_janitor():
+    global _janitor_task
+    if _janitor_task is not None:
+        _janitor_task.cancel()
+        _janitor_task = None
+
+
+def get_disk_stats() -> dict:
+    return {
+        "dir_usage": _downloads_dir_usage(),
+        "quota": config.DOWNLOADS_QUOTA,
+        "free": _disk_free(),
+        "reserved": sum(_disk_reservations.values()),
+        **_janitor_stats,
+    }
+
+
+# --- адаптивный допуск ---
+_admission_task = None
+
+
+def estimate_job_cost(url: str, quality: str) -> int:
+    """
+    Оценка памяти задания: сам yt-dlp плюс склейка ffmpeg'ом, если выбранный формат
+    состоит из отдельных видео и аудио. Без метаданных считаем худший случай — склейку.
+    """
+    height = _requested_height(quality)
+    info = get_cached_info(url)
+    merge_height = height
+    if info:
+        selected = select_format(info, height, get_size_budget())
+        if selected is not None:
+            candidate = next((c for c in _format_candidates(info, height) if c[0] == selected), None)
+            merge_height = candidate[1] if "+" in selected else 0
+    if not merge_height:
+        return config.ADMISSION_JOB_MEMORY
+    tiers = sorted(config.ADMISSION_MERGE_MEMORY.items())
+    merge = next((memory for tier, memory in tiers if merge_height <= tier), tiers[-1][1])
+    return config.ADMISSION_JOB_MEMORY + merge
+
+
+async def _admission_loop():
+    while True:
+        try:
+            admission.update(len(_running_jobs), len(_waiting_jobs))
+            # Лимит мог вырасти, а свежий замер памяти — вместить отложенные задания
+            _dispatch()
+        except Exception as e:
+            logger.error(f"Ошибка адаптивного допуска: {e}")
+        await asyncio.sleep(config.ADMISSION_INTERVAL)
+
+
+def start_admission():
+    """Запустить периодический пересчет лимита скачиваний"""
+    global _admission_task
+    if _admission_task is None and config.DOWNLOAD_BACKEND != "queue":
+        _admission_task = asyncio.create_task(_admission_loop())
+
+
+def stop_admission():
+    global _admission_task
+    if _admission_task is not None:
+        _admission_task.cancel()
+        _admission_task = None
+
+
+# --- совместные скачивания ---
+_inflight = {}    # {(url, quality): job} — скачивания, которые идут или чей файл еще отправляется
+_file_refs = {}   # {file_path: job} — готовые файлы, которые еще отправляются
+
+
+def get_job_key(url: str, quality: str):
+    """Ключ задания скачивания (для совместных скачиваний и прогресса)"""
+    parsed = parse_video_url(url)
+    if parsed:
+        return (parsed[0], parsed[1], str(quality))
+    return (url, str(quality))
+
+
+async def acquire_video(url: str, quality: str, user_id: int = None, on_position=None, prefetch: dict = None) -> str:
+    """
+    Получить файл видео. Одинаковые одновременные запросы присоединяются
+    к уже идущему скачиванию. После отправки файл нужно вернуть через release_video.
+    """
+    key = get_job_key(url, quality)
+    job = _inflight.get(key)
+    # К отмененной предзагрузке не присоединяемся — она вот-вот завершится ошибкой
+    if job is None or (job["prefetch"] is not None and job["prefetch"]["abort"].is_set()):
+        job = {"future": asyncio.get_running_loop().create_future(), "refs": 0, "key": key, "url": url, "prefetch": prefetch}
+        _inflight[key] = job
+        asyncio.create_task(_run_shared_download(key, job, url, quality, user_id, on_position))
+    else:
+        logger.info(f"Присоединяемся к идущему скачиванию {url} ({quality}p)")
+
+    job["refs"] += 1
+    if prefetch is None and key in _prefetches:
+        # Пользователь выбрал предзагружаемое качество — скачивание становится обычным
+        _promote_prefetch(key)
+    try:
+        # shield: отмена одного получателя не должна отменять общее скачивание
+        return await asyncio.shield(job["future"])
+    except BaseException:
+        job["refs"] -= 1
+        raise
+
+
+async def _run_shared_download(key, job: dict, url: str, quality: str, user_id: int = None, on_position=None):
+    future = job["future"]
+    try:
+        file_path = await run_download(url, quality, user_id, on_position, progress_key=key, prefetch=job["prefetch"])
+    except asyncio.CancelledError:
+        if _inflight.get(key) is job:
+            del _inflight[key]
+        future.cancel()
+        raise
+    except Exception as e:
+        if _inflight.get(key) is job:
+            del _inflight[key]
+        if isinstance(e, DownloadCancelled):
+            _remove_partial_files(key, url)
+        future.set_exception(e)
+        future.exception()  # помечаем как полученное, даже если ждать уже некому
+        return
+    finally:
+        progress.finish(key)
+
+    # Задание остается в _inflight, пока файл отправляется: новый запрос того же видео
+    # должен получить этот файл, а не скачивать заново по тому же пути,
+    # который удалит release_video первого получателя
+    _file_refs[file_path] = job
+    future.set_result(file_path)
+    if job["refs"] <= 0:
+        # все получатели отменили ожидание
+        _remove_file(file_path)
+
+
+async def fit_video(file_path: str, progress_key=None) -> str:
+    """Подогнать файл под лимит в пуле перекодирования; при ошибке файл удаляется"""
+    budget = get_size_budget()
+    size = os.path.getsize(file_path)
+    # Обычный случай — mp4 в пределах лимита: не ставим его в очередь за чужим перекодированием
+    if size <= budget and file_path.endswith(".mp4"):
+        return file_path
+    if size > budget and progress_key is not None:
+        progress.report(progress_key, f"🎞 Сжимаю видео до {budget // (1024 * 1024)} МБ...")
+    loop = asyncio.get_running_loop()
+    try:
+        with metrics.timer("transcode"):
+            return await loop.run_in_executor(get_transcode_executor(), transcode.fit_to_limit, file_path, budget)
+    except Exception:
+        _remove_file(file_path)
+        raise
+
+
+def release_video(file_path: str):
+    """Отметить, что файл доставлен; удаляется после последнего получателя"""
+    job = _file_refs.get(file_path)
+    if job is not None:
+        job["refs"] -= 1
+        if job["refs"] > 0:
+            return
+    _remove_file(file_path)
+
+
+def _remove_partial_files(key, url: str):
+    """Удалить недокачанные файлы прерванного скачивания (.part, фрагменты)"""
+    info = get_cached_info(url)
+    if not info or not info.get("id"):
+        return
+    # Файлы этого качества уже могут принадлежать новому скачиванию
+    if key in _inflight:
+        return
+    prefix = f"{info['id']}_{_requested_height(key[-1])}_"
+    for path in glob.glob(os.path.join(config.DOWNLOADS_DIR, glob.escape(prefix) + "*")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _remove_file(file_path: str):
+    job = _file_refs.pop(file_path, None)
+    if job is not None and _inflight.get(job["key"]) is job:
+        del _inflight[job["key"]]
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Не удалось удалить файл {file_path}: {e}")
+
+
+# --- предзагрузка вероятного качества ---
+# Пока пользователь выбирает качество, заранее качаем то, что на этом сайте выбирают
+# чаще всего. Ключ — ключ задания; после выбора запись удаляется
+_prefetches = {}  # {ключ задания: {"key", "abort", "slot", "task", "timer"}}
+_prefetch_stats = {"started": 0, "promoted": 0, "cancelled": 0, "preempted": 0}
+
+
+def _make_abort_hook(abort: threading.Event, inner=None):
+    """progress_hook, который прерывает скачивание yt-dlp, когда abort установлен"""
+    def hook(d: dict):
+        if abort.is_set():
+            raise DownloadCancelled("Предзагрузка отменена")
+        if inner:
+            inner(d)
+
+    return hook
+
+
+def start_prefetch(url: str):
+    """
+    Начать скачивание вероятного качества. Только в свободный слот и в пуле потоков:
+    прервать скачивание можно лишь из progress_hook в этом же процессе.
+    """
+    if not config.ENABLE_PREFETCH or config.DOWNLOAD_BACKEND != "local" or config.DOWNLOAD_POOL_TYPE == "process":
+        return
+    # Без метаданных в кеше список качеств потребовал бы экстракции прямо в event loop
+    if get_cached_info(url) is None:
+        return
+    quality = get_likely_quality(url, get_available_qualities(url))
+    if quality is None:
+        return
+    key = get_job_key(url, quality)
+    if key in _inflight or key in _prefetches or get_media_key(url, quality) in _file_id_cache:
+        return
+    if _waiting_jobs or not _can_start(estimate_job_cost(url, quality)):
+        return
+
+    prefetch = {"key": key, "abort": threading.Event(), "slot": None}
+    prefetch["task"] = asyncio.create_task(_run_prefetch(prefetch, url, quality))
+    prefetch["timer"] = asyncio.get_running_loop().call_later(config.PREFETCH_TTL, cancel_prefetch, key)
+    _prefetches[key] = prefetch
+    _prefetch_stats["started"] += 1
+    logger.info(f"Предзагрузка {url} ({quality}p)")
+
+
+async def _run_prefetch(prefetch: dict, url: str, quality: str):
+    file_path = None
+    try:
+        file_path = await acquire_video(url, quality, prefetch=prefetch)
+        # Файл готов: держим его, пока пользователь не выберет качество или не истечет PREFETCH_TTL
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.info(f"Предзагрузка {url} ({quality}p) не состоялась: {e}")
+    finally:
+        if _prefetches.get(prefetch["key"]) is prefetch:
+            del _prefetches[prefetch["key"]]
+            prefetch["timer"].cancel()
+        if file_path:
+            release_video(file_path)
+
+
+def _promote_prefetch(key):
+    """Пользователь присоединился к предзагрузке: она больше не вытесняется и не отменяется"""
+    prefetch = _prefetches.pop(key)
+    prefetch["timer"].cancel()
+    prefetch["task"].cancel()  # задача только отпускает свою ссылку на файл
+    _prefetch_stats["promoted"] += 1
+
+
+def cancel_prefetch(key, reason: str = "cancelled"):
+    """Прервать невыбранную предзагрузку и убрать ее файлы"""
+    prefetch = _prefetches.pop(key, None)
+    if prefetch is None:
+        return
+    prefetch["timer"].cancel()
+    prefetch["abort"].set()
+    prefetch["task"].cancel()
+    _prefetch_stats[reason] += 1
+
+
+def cancel_other_prefetches(url: str, quality: str):
+    """Пользователь выбрал качество: предзагрузки других качеств этого видео не нужны"""
+    key = get_job_key(url, quality)
+    for other in [k for k in _prefetches if k[:-1] == key[:-1] and k != key]:
+        cancel_prefetch(other)
+
+
+def _preempt_prefetch():
+    """Освободить слот для обычного скачивания, прервав одну невыбранную предзагрузку"""
+    for key, prefetch in list(_prefetches.items()):
+        if prefetch["slot"] in _running_jobs:
+            cancel_prefetch(key, "preempted")
+            return
+
+
+def get_prefetch_stats() -> dict:
+    return {"active": len(_prefetches), **_prefetch_stats}
+
+
+# --- аналитика ---
+def track_user_activity(user_id: int, action: str = "visit"):
+    """Отслеживать активность пользователя"""
+    today = _get_today_date()
+    
+    # Обновляем активность пользователя (на диск — только при изменении, не на каждое сообщение)
+    if user_id not in _analytics["user_activity"]:
+        _analytics["user_activity"][user_id] = {
+            "first_seen": today,
+            "last_seen": today,
+            "total_downloads": 0,
+            "subscription_status": False
+        }
+        _persist_user(user_id)
+    elif _analytics["user_activity"][user_id]["last_seen"] != today:
+        _analytics["user_activity"][user_id]["last_seen"] = today
+        _persist_user(user_id)
+    
+    # Обновляем ежедневную статистику
+    active = _get_day_stats(today)[1]
+    if user_id not in active:
+        active.add(user_id)
+        storage.put("daily_active", (today, len(active)))
+
+def _get_day_stats(today: str) -> list:
+    """
+    Счетчики текущего дня. При смене дня вчерашнее множество активных
+    сворачивается в число, а дни старше config.ANALYTICS_DAYS удаляются.
+    """
+    days = _analytics["days"]
+    stats = days.get(today)
+    if stats is None:
+        for day_stats in days.values():
+            if isinstance(day_stats[1], set):
+                day_stats[1] = len(day_stats[1])
+        stats = days[today] = [0, set()]
+        while len(days) > config.ANALYTICS_DAYS:
+            days.popitem(last=False)
+    return stats
+
+def _persist_user(user_id: int):
+    data = _analytics["user_activity"][user_id]
+    storage.put("user_activity", (
+        user_id, data["first_seen"], data["last_seen"],
+        data["total_downloads"], int(data["subscription_status"]),
+    ))
+
+def track_subscription(user_id: int, is_subscribed: bool):
+    """Отслеживать статус подписки"""
+    # Пишем на диск только при смене статуса — проверка идет на каждое сообщение
+    changed = (user_id in _analytics["subscribed_users"]) != is_subscribed
+    if is_subscribed:
+        _analytics["subscribed_users"].add(user_id)
+        if user_id in _analytics["user_activity"]:
+            _analytics["user_activity"][user_id]["subscription_status"] = True
+    else:
+        _analytics["subscribed_users"].discard(user_id)
+        if user_id in _analytics["user_activity"]:
+            _analytics["user_activity"][user_id]["subscription_status"] = False
+    if changed and user_id in _analytics["user_activity"]:
+        _persist_user(user_id)
+
+def track_download(user_id: int):
+    """Отслеживать скачивание"""
+    today = _get_today_date()
+    
+    # Увеличиваем счетчик ежедневных скачиваний
+    day_stats = _get_day_stats(today)
+    day_stats[0] += 1
+    _analytics["total_downloads"] += 1
+    storage.put("daily_downloads", (today, day_stats[0]))
+    
+    # Обновляем статистику пользователя
+    if user_id in _analytics["user_activity"]:
+        _analytics["user_activity"][user_id]["total_downloads"] += 1
+        _persist_user(user_id)
+
+def track_quality_choice(url: str, quality: str):
+    """Запомнить выбор качества по сайту — по этой статистике работает предзагрузка"""
+    parsed = parse_video_url(url)
+    site = parsed[0] if parsed else "other"
+    choices = _analytics["quality_choices"].setdefault(site, {})
+    choices[str(quality)] = choices.get(str(quality), 0) + 1
+    storage.put("quality_choices", (site, str(quality), choices[str(quality)]))
+
+
+def get_likely_quality(url: str, qualities: list) -> str | None:
+    """Самое частое на этом сайте качество из предложенных, если статистике можно доверять"""
+    parsed = parse_video_url(url)
+    choices = _analytics["quality_choices"].get(parsed[0] if parsed else "other", {})
+    offered = {str(q): choices.get(str(q), 0) for q in qualities}
+    total = sum(offered.values())
+    if not offered or total < config.PREFETCH_MIN_CHOICES:
+        return None
+    quality, count = max(offered.items(), key=lambda item: item[1])
+    if count / total < config.PREFETCH_MIN_SHARE:
+        return None
+    return quality
+
+
+def get_analytics_summary():
+    """Получить сводку аналитики"""
+    today = _get_today_date()
+    
+    # Статистика пользователей
+    total_users = len(_analytics["user_activity"])
+    subscribed_users = len(_analytics["subscribed_users"])
+    subscription_rate = (subscribed_users / total_users * 100) if total_users > 0 else 0
+    
+    # Статистика скачиваний и активности — готовые счетчики, O(дней)
+    today_stats = _get_day_stats(today)
+    
+    return {
+        "total_users": total_users,
+        "subscribed_users": subscribed_users,
+        "subscription_rate": round(subscription_rate, 1),
+        "today_downloads": today_stats[0],
+        "total_downloads": _analytics["total_downloads"],
+        "active_users_today": len(today_stats[1]),
+        "daily_stats": {date: stats[0] for date, stats in _analytics["days"].items()},
+        "daily_active": {
+            date: stats[1] if isinstance(stats[1], int) else len(stats[1])
+            for date, stats in _analytics["days"].items()
+        },
+    }
+
+def get_user_stats(user_id: int):
+    """Получить статистику конкретного пользователя"""
+    if user_id not in _analytics["user_activity"]:
+        return None
+    
+    user_data = _analytics["user_activity"][user_id]
+    return {
+        "user_id": user_id,
+        "first_seen": user_data["first_seen"],
+        "last_seen": user_data["last_seen"],
+        "total_downloads": user_data["total_downloads"],
+        "is_subscribed": user_data["subscription_status"]
+    }
+
+
+# --- ограничения скачиваний ---
+def _get_today_date():
+    """Получить текущую дату в формате YYYY-MM-DD"""
+    from datetime import datetime
+    return datetime.now().strftime("%Y-%m-%d")
+
+def _get_date_days_ago(days: int) -> str:
+    from datetime import datetime, timedelta
+    return (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+
+def _get_today_day() -> int:
+    """Номер текущего дня (по местному времени) — дешевле форматирования даты"""
+    now = time.time()
+    return int((now + time.localtime(now).tm_gmtoff) // 86400)
+
+def _get_quota(user_id: int) -> list:
+    """
+    Запись лимита пользователя за сегодня. Сброс ленивый: запись за прошлый
+    день просто заменяется при первом обращении, без обхода всех пользователей.
+    """
+    today = _get_today_day()
+    entry = _download_counts.get(user_id)
+    if entry is None or entry[0] != today:
+        entry = [today, 0, 0]
+        _download_counts.set(user_id, entry)
+    return entry
+
+def _persist_quota(user_id: int, entry: list):
+    storage.put("download_counts", (user_id, _get_today_date(), entry[1]))
+
+def get_user_download_count(user_id: int) -> int:
+    """Получить количество скачиваний пользователя за сегодня (включая идущие)"""
+    entry = _download_counts.get(user_id)
+    if entry is None or entry[0] != _get_today_day():
+        return 0
+    return entry[1] + entry[2]
+
+def reserve_download(user_id: int, max_downloads: int = 5) -> bool:
+    """
+    Зарезервировать одно скачивание из дневного лимита. Лимиты меняются только
+    в обработчиках event loop, а между проверкой и резервом нет await, —
+    параллельные нажатия не превысят лимит.
+    """
+    entry = _get_quota(user_id)
+    if entry[1] + entry[2] >= max_downloads:
+        return False
+    entry[2] += 1
+    return True
+
+def commit_download(user_id: int) -> int:
+    """Подтвердить зарезервированное скачивание (видео доставлено)"""
+    entry = _get_quota(user_id)
+    # резерв мог остаться во вчерашнем дне — тогда просто засчитываем сегодня
+    entry[2] = max(0, entry[2] - 1)
+    entry[1] += 1
+    _persist_quota(user_id, entry)
+    
+    # Отслеживаем скачивание в аналитике
+    track_download(user_id)
+    
+    return entry[1]
+
+def refund_download(user_id: int):
+    """Вернуть зарезервированное скачивание (ошибка или отмена)"""
+    entry = _get_quota(user_id)
+    entry[2] = max(0, entry[2] - 1)
+
+def can_user_download(user_id: int, max_downloads: int = 5) -> bool:
+    """Проверить, может ли пользователь скачать видео"""
+    return get_user_download_count(user_id) < max_downloads
+
+def get_remaining_downloads(user_id: int, max_downloads: int = 5) -> int:
+    """Получить количество оставшихся скачиваний"""
+    return max(0, max_downloads - get_user_download_count(user_id))
+
+
+# --- кеш подписки ---
+_MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def _check_cache(user_id: int, channel: str, allow_stale: bool = False):
+    entry = _subscription_cache.get((user_id, channel))
+    if entry is not None:
+        is_member, fresh_until = entry
+        if allow_stale or time.time() < fresh_until:
+            return is_member
+    return None
+
+
+def _set_cache(user_id: int, channel: str, is_member: bool, ttl: float = None):
+    fresh_until = time.time() + (ttl or config.CACHE_TIMEOUT)
+    _subscription_cache.set((user_id, channel), (is_member, fresh_until))
+    storage.put("subscriptions", (user_id, channel, int(is_member), fresh_until))
+
+
+async def _fetch_membership(bot, channel: str, user_id: int) -> bool:
+    member = await bot.get_chat_member(channel, user_id)
+    return member.status in _MEMBER_STATUSES
+
+
+async def check_subscription(user_id: int, context) -> bool:
+    """
+    Проверка подписки на каналы из config.CHANNELS.
+    Каналы без актуального кеша запрашиваются параллельно.
+    """
+    missing = []
+    for ch in config.CHANNELS:
+        cached = _check_cache(user_id, ch)
+        if cached is False:
+            track_subscription(user_id, False)
+            return False
+        if cached is None:
+            missing.append(ch)
+
+    is_sub = True
+    if missing:
+        with metrics.timer("subscription"):
+            results = await asyncio.gather(
+                *[_fetch_membership(context.bot, ch, user_id) for ch in missing],
+                return_exceptions=True,
+            )
+        for ch, result in zip(missing, results):
+            if isinstance(result, Exception):
+                # Временную ошибку API не кешируем: используем последний известный статус
+                logger.warning(f"Ошибка проверки подписки на {ch}: {result}")
+                result = bool(_check_cache(user_id, ch, allow_stale=True))
+            else:
+                _set_cache(user_id, ch, result)
+            is_sub = is_sub and result
+
+    track_subscription(user_id, is_sub)
+    return is_sub
+
+
+def _channel_name(chat) -> str | None:
+    """Найти канал из config.CHANNELS по объекту чата"""
+    candidates = {str(chat.id)}
+    if chat.username:
+        candidates.add(f"@{chat.username}".lower())
+    for ch in config.CHANNELS:
+        if ch.lower() in candidates:
+            return ch
+    return None
+
+
+def update_membership(user_id: int, chat, status: str):
+    """
+    Обновить кеш подписки по событию chat_member (вступление/выход из канала)
+    """
+    channel = _channel_name(chat)
+    if channel is None:
+        return
+    is_member = status in _MEMBER_STATUSES
+    _set_cache(user_id, channel, is_member, ttl=config.CHAT_MEMBER_EVENT_TTL)
+    if not is_member:
+        track_subscription(user_id, False)
+    elif all(_check_cache(user_id, ch) for ch in config.CHANNELS):
+        track_subscription(user_id, True)
+
+
+# --- нормализация ссылок ---
+# Таблица маршрутов: (сайт, ie_key экстрактора yt-dlp, хосты, регулярка по "путь?query",
+# шаблон канонической ссылки). Каноническая ссылка — ключ кешей и совместных скачиваний,
+# ie_key передается в yt-dlp, чтобы он не перебирал все экстракторы
+_YOUTUBE_HOSTS = ("youtube.com", "m.youtube.com", "music.youtube.com", "youtube-nocookie.com")
+_YOUTUBE_URL = "https://www.youtube.com/watch?v={id}"
+_URL_ROUTES = (
+    ("youtube", "Youtube", _YOUTUBE_HOSTS, r"/watch/?\?(?:[^#]*&)?v=(?P<id>[\w-]{11})", _YOUTUBE_URL),
+    ("youtube", "Youtube", _YOUTUBE_HOSTS, r"/(?:shorts|embed|live|v)/(?P<id>[\w-]{11})", _YOUTUBE_URL),
+    ("youtube", "Youtube", ("youtu.be",), r"/(?P<id>[\w-]{11})", _YOUTUBE_URL),
+    ("tiktok", "TikTok", ("tiktok.com", "m.tiktok.com"), r"/@(?P<user>[\w.-]+)/video/(?P<id>\d+)",
+     "https://www.tiktok.com/@{user}/video/{id}"),
+    ("tiktok", "TikTok", ("tiktok.com", "m.tiktok.com"), r"/v/(?P<id>\d+)", "https://www.tiktok.com/embed/{id}"),
+    ("tiktok", "TikTokVM", ("tiktok.com", "m.tiktok.com"), r"/t/(?P<id>\w+)", "https://www.tiktok.com/t/{id}/"),
+    ("tiktok", "TikTokVM", ("vm.tiktok.com", "vt.tiktok.com"), r"/(?P<id>\w+)", "https://vm.tiktok.com/{id}/"),
+    # /p/ только в начале пути (или после имени профиля), а не где угодно в ссылке
+    ("instagram", "Instagram", ("instagram.com",), r"/(?:[\w.]+/)?(?:p|reels?|tv)/(?P<id>[\w-]+)",
+     "https://www.instagram.com/p/{id}/"),
+    ("vk", "VK", ("vk.com", "m.vk.com", "vkvideo.ru"), r"/(?:video|clip)(?P<id>-?\d+_\d+)", "https://vk.com/video{id}"),
+    ("vk", "VK", ("vk.com", "m.vk.com"), r"/[^?]*\?(?:[^#]*&)?z=(?:video|clip)(?P<id>-?\d+_\d+)", "https://vk.com/video{id}"),
+    # Хеш закрытой (unlisted) ссылки без него yt-dlp видео не отдаст
+    ("vimeo", "Vimeo", ("player.vimeo.com",), r"/video/(?P<id>\d+)\?(?:[^#]*&)?h=(?P<hash>[0-9a-f]+)",
+     "https://vimeo.com/{id}/{hash}"),
+    ("vimeo", "Vimeo", ("vimeo.com", "player.vimeo.com"), r"/(?:[^?#]*?/)?(?P<id>\d+)(?P<hash>/[0-9a-f]+)?/?(?:[?#]|$)",
+     "https://vimeo.com/{id}{hash}"),
+    ("dailymotion", "Dailymotion", ("dailymotion.com",), r"/video/(?P<id>[a-z0-9]+)",
+     "https://www.dailymotion.com/video/{id}"),
+    ("dailymotion", "Dailymotion", ("dai.ly",), r"/(?P<id>[a-z0-9]+)", "https://www.dailymotion.com/video/{id}"),
+)
+_ROUTES_BY_HOST = {}  # {хост: [(сайт, ie_key, скомпилированная регулярка, шаблон)]}
+for _site, _ie_key, _hosts, _pattern, _template in _URL_ROUTES:
+    for _host in _hosts:
+        _ROUTES_BY_HOST.setdefault(_host, []).append((_site, _ie_key, re.compile(_pattern), _template))
+
+
+def _match_route(url: str):
+    """(сайт, id видео, каноническая ссылка, ie_key) или None"""
+    if not url:
+        return None
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return None
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    routes = _ROUTES_BY_HOST.get(host)
+    if not routes:
+        return None
+    target = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    for site, ie_key, regex, template in routes:
+        match = regex.match(target)
+        if match:
+            # Необязательные группы, которые не совпали, в ссылку не попадают
+            groups = {name: value or "" for name, value in match.groupdict().items()}
+            return site, match.group("id"), template.format(**groups), ie_key
+    return None
+
+
+def parse_video_url(url: str) -> tuple | None:
+    """(сайт, id видео, каноническая ссылка) или None, если ссылка не поддерживается"""
+    route = _match_route(url)
+    return route[:3] if route else None
+
+
+def normalize_video_url(url: str) -> str | None:
+    route = _match_route(url)
+    return route[2] if route else None
+
+
+def get_ie_key(url: str) -> str | None:
+    """Экстрактор yt-dlp для ссылки, чтобы не перебирать все по очереди"""
+    route = _match_route(url)
+    return route[3] if route else None
+
+
+# --- кеш метаданных ---
+_info_cache = BoundedCache("метаданные", config.INFO_CACHE_SIZE, config.INFO_CACHE_TTL)  # {url: info}
+
+
+def get_cached_info(url: str):
+    """Получить метаданные из кеша или None"""
+    return _info_cache.get(url)
+
+
+def _set_cached_info(url: str, info: dict):
+    _info_cache.set(url, info)
+
+
+def get_video_info(url: str) -> dict | None:
+    """
+    Получить метаданные видео (без выбора формата), с кешированием по нормализованной ссылке
+    """
+    info = get_cached_info(url)
+    if info is not None:
+        return info
+
+    ydl_opts = {
+        "quiet": True,
+        "no_warnings": True,
+        "noplaylist": True,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl, metrics.timer("metadata"):
+        # process=False: список форматов без выбора, чтобы download_video
+        # мог применить свой format через process_ie_result
+        info = ydl.extract_info(url, download=False, process=False, ie_key=get_ie_key(url))
+        if info:
+            info = ydl.sanitize_info(info)
+            _set_cached_info(url, info)
+        return info
+
+
+# --- кеш file_id отправленных видео ---
+_file_id_cache = BoundedCache("file_id", config.FILE_ID_CACHE_SIZE)  # {"extractor:video_id:quality": file_id}
+
+
+def get_media_key(url: str, quality: str) -> str:
+    """Ключ кеша: (экстрактор, id видео, качество) — по ссылке или по метаданным"""
+    route = _match_route(url)
+    if route:
+        return f"{route[3]}:{route[1]}:{quality}"
+    info = get_cached_info(url)
+    if info and info.get("id"):
+        extractor = info.get("extractor_key") or info.get("ie_key") or "generic"
+        return f"{extractor}:{info['id']}:{quality}"
+    return f"url:{url}:{quality}"
+
+
+def get_extractor(url: str) -> str:
+    """Сайт видео по кешу метаданных (для метрик)"""
+    info = get_cached_info(url)
+    if info:
+        return info.get("extractor_key") or info.get("ie_key") or "generic"
+    return get_ie_key(url) or "unknown"
+
+
+def get_cached_file_id(media_key: str) -> str | None:
+    return _file_id_cache.get(media_key)
+
+
+def remember_file_id(media_key: str, file_id: str):
+    _file_id_cache[media_key] = file_id
+    storage.put("file_ids", (media_key, file_id))
+
+
+def forget_file_id(media_key: str):
+    """Удалить file_id, который Telegram больше не принимает"""
+    if _file_id_cache.pop(media_key, None) is not None:
+        storage.delete("file_ids", (media_key,))
+
+
+def get_file_id_cache_stats() -> dict:
+    stats = _file_id_cache.stats()
+    total = stats["hits"] + stats["misses"]
+    return {
+        "entries": stats["size"],
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "hit_rate": (stats["hits"] / total * 100) if total else 0,
+    }
+
+
+
+# --- доступные качества ---
+def get_available_qualities(url: str) -> list[int]:
+    """
+    Получить список доступных качеств для видео
+    """
+    try:
+        info = get_video_info(url)
+        if not info or 'formats' not in info:
+            # Если не удалось получить информацию, возвращаем стандартные качества
+            return [480, 720, 1080]
+        
+        # Извлекаем доступные разрешения
+        available_heights = set()
+        for fmt in info['formats']:
+            if fmt.get('height') and fmt.get('vcodec') != 'none':
+                available_heights.add(fmt['height'])
+        
+        # Сортируем и фильтруем качества
+        heights = sorted([h for h in available_heights if h >= 360], reverse=True)
+        
+        # Возвращаем до 3 лучших качеств
+        if not heights:
+            return [480, 720, 1080]  # Fallback
+        
+        # Выбираем лучшие доступные качества
+        selected = []
+        for target in [1080, 720, 480]:
+            for height in heights:
+                if height >= target and target not in selected:
+                    selected.append(target)
+                    break
+
+        return selected if selected else [heights[0]] if heights else [720]
+
+    except Exception as e:
+        logger.warning(f"Не удалось получить доступные качества: {e}")
+        # Возвращаем стандартные качества в случае ошибки
+        return [480, 720, 1080]
+
+
+# --- оценка размера ---
+def get_size_budget() -> int:
+    """Максимальный размер итогового файла"""
+    return min(config.MAX_FILE_SIZE, config.TELEGRAM_LIMIT)
+
+
+def get_download_cap() -> int:
+    """Максимальный размер скачиваемого файла: с перекодированием больше бюджета — его сожмут"""
+    if config.ENABLE_TRANSCODE:
+        return max(config.TRANSCODE_MAX_INPUT, get_size_budget())
+    return get_size_budget()
+
+
+def _estimate_format_size(fmt: dict, duration) -> int | None:
+    """Размер формата: точный, примерный или по битрейту (кбит/с) и длительности"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    bitrate = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+
+def _split_formats(info: dict):
+    """Разделить форматы на видео (с высотой) и только-аудио"""
+    videos, audios = [], []
+    for fmt in info.get("formats") or []:
+        if fmt.get("vcodec") != "none" and fmt.get("height"):
+            videos.append(fmt)
+        elif fmt.get("vcodec") == "none" and fmt.get("acodec") not in (None, "none"):
+            audios.append(fmt)
+    return videos, audios
+
+
+def _format_candidates(info: dict, height: int):
+    """
+    Комбинации форматов не выше height от лучших к худшим:
+    (format_spec, высота, оценка размера или None)
+    """
+    duration = info.get("duration")
+    videos, audios = _split_formats(info)
+    best_audio = max(audios, key=lambda f: f.get("abr") or f.get("tbr") or 0, default=None)
+    audio_size = _estimate_format_size(best_audio, duration) if best_audio else 0
+
+    candidates = []
+    for fmt in videos:
+        if fmt["height"] > height:
+            continue
+        size = _estimate_format_size(fmt, duration)
+        if fmt.get("acodec") == "none":
+            if best_audio is None:
+                continue
+            spec = f"{fmt['format_id']}+{best_audio['format_id']}"
+            size = size + audio_size if size is not None and audio_size is not None else None
+        else:
+            spec = fmt["format_id"]
+        candidates.append((spec, fmt["height"], size, fmt.get("tbr") or 0))
+    candidates.sort(key=lambda c: (c[1], c[3]), reverse=True)
+    return [c[:3] for c in candidates]
+
+
+def estimate_quality_size(info: dict, height: int) -> int | None:
+    """Оценка размера файла, который выбрал бы обычный селектор для этого качества"""
+    candidates = _format_candidates(info, height)
+    return candidates[0][2] if candidates else None
+
+
+def select_format(info: dict, height: int, budget: int) -> str | None:
+    """
+    Лучшая комбинация форматов не выше height, которая укладывается в budget.
+    Если не укладывается ни одна — самая маленькая из тех, чей размер известен
+    (ее сожмет перекодирование). None — если форматов нет или размеры неизвестны (тогда решает yt-dlp).
+    """
+    candidates = _format_candidates(info, height)
+    for spec, _, size in candidates:
+        if size is not None and size <= budget:
+            return spec
+    sized = [c for c in candidates if c[2] is not None]
+    return min(sized, key=lambda c: c[2])[0] if sized else None
+
+
+# --- скачивание видео ---
+def _requested_height(quality: str) -> int:
+    """Высота, которую просил пользователь (720, если качество не число)"""
+    try:
+        return int(quality)
+    except (TypeError, ValueError):
+        return 720
+
+
+class RetryDownload(Exception):
+    """Попытка не удалась, повторить через delay секунд с состоянием повторов retry"""
+
+    def __init__(self, delay: float, retry: dict):
+        super().__init__(delay, retry)  # args — чтобы исключение пережило передачу из пула процессов
+        self.delay = delay
+        self.retry = retry
+
+
+def download_video(url: str, quality: str, info: dict = None, progress_hook=None, retry: dict = None) -> str:
+    """
+    Скачать видео с повторами по типу ошибки. Если передан retry (состояние повторов,
+    сначала пустое), пауза перед повтором не делается здесь: поднимается RetryDownload,
+    и вызывающий повторяет вызов с e.retry, не занимая поток и слот на время паузы.
+    """
+    height = _requested_height(quality)
+
+    os.makedirs(config.DOWNLOADS_DIR, exist_ok=True)
+    budget = get_size_budget()
+
+    ydl_opts = {
+        # Улучшенная логика выбора качества - сначала ищем точное качество, потом лучшее доступное
+        "format": f"bestvideo[height<={height}]+bestaudio/best[height<={height}]/bestvideo+bestaudio/best",
+        # Запрошенное качество в имени: запросы 1080 и 720 могут выбрать один и тот же формат,
+        # а совместные скачивания различаются по запрошенному качеству — путь должен быть свой
+        "outtmpl": os.path.join(config.DOWNLOADS_DIR, f"%(id)s_{height}_%(height)sp.%(ext)s"),
+        "merge_output_format": "mp4",
+        "ffmpeg_location": config.FFMPEG_PATH,
+        "noplaylist": True,
+        "quiet": True,
+        # Не начинаем скачивать форматы, которые заведомо больше лимита (с перекодированием — больше того, что можно сжать)
+        "max_filesize": get_download_cap(),
+        "http_headers": {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+            "Accept-Language": "en-US,en;q=0.5",
+            "Accept-Encoding": "gzip, deflate",
+            "DNT": "1",
+            "Connection": "keep-alive",
+            "Upgrade-Insecure-Requests": "1",
+        },
+        "geo_bypass": True,
+        "nocheckcertificate": True,
+        "retries": 5,
+        "socket_timeout": 60,
+        "extractor_retries": 3,
+        "fragment_retries": 5,
+        "skip_unavailable_fragments": True,
+        # При повторе продолжаем с недокачанного .part файла, а не с нуля
+        "continuedl": True,
+        # mtime — время скачивания, а не Last-Modified сервера: по нему очистка ищет брошенные файлы
+        "updatetime": False,
+        "keep_fragments": False,  # фрагменты после склейки не нужны и только занимают диск
+        "extract_flat": False,
+        "writethumbnail": False,
+        "writeinfojson": False,
+        "ignoreerrors": False,
+        "no_color": True,
+        "prefer_insecure": False,
+        "legacy_server_connect": True,
+        # Дополнительные настройки для лучшего качества
+        "format_sort": ["res", "ext:mp4:m4a", "proto:https", "proto:http"],
+        "format_sort_force": True,
+    }
+    if progress_hook:
+        ydl_opts["progress_hooks"] = [progress_hook]
+    ydl_opts["postprocessor_hooks"] = [_make_merge_timer()]
+
+    if info is None:
+        info = get_cached_info(url)
+
+    # Выбираем форматы по оценке размера заранее, чтобы не качать то, что потом не отправить
+    if info:
+        selected = select_format(info, height, budget)
+        if selected:
+            logger.info(f"Выбран формат {selected} для {height}p (лимит {budget // (1024 * 1024)}MB)")
+            ydl_opts["format"] = f"{selected}/{ydl_opts['format']}"
+
+    # attempts — {тип ошибки: число повторов}; format и refetch — что поменять в следующей попытке
+    state = {"attempts": {}, "total": 0, "format": None, "refetch": False, **copy.deepcopy(retry or {})}
+    attempts = state["attempts"]
+    if state["format"]:
+        ydl_opts["format"] = state["format"]
+    if state["refetch"]:
+        info = None
+    while True:
+        state["total"] += 1
+        total_attempts = state["total"]
+        try:
+            file_path = _download_once(url, ydl_opts, info)
+            _record_attempt("success" if total_attempts == 1 else "recovered")
+            return file_path
+        except DownloadCancelled:
+            _record_attempt("cancelled")
+            raise
+        except Exception as e:
+            category = classify_download_error(e)
+            _record_attempt(category)
+            max_retries, base_delay = config.DOWNLOAD_RETRY_POLICY[category]
+            attempts[category] = attempts.get(category, 0) + 1
+            if attempts[category] > max_retries or total_attempts >= config.DOWNLOAD_MAX_ATTEMPTS:
+                _record_attempt("failed")
+                logger.error(f"Ошибка скачивания видео ({category}), попыток {total_attempts}: {e}")
+                raise
+
+            delay = base_delay * 2 ** (attempts[category] - 1)
+            logger.warning(
+                f"Ошибка скачивания ({category}): {e}. "
+                f"Повтор {attempts[category]}/{max_retries} через {delay} сек"
+            )
+            if category == "merge":
+                # Не склеиваем потоки: берем готовый файл с видео и звуком
+                state["format"] = ydl_opts["format"] = f"best[height<={height}]/best"
+            elif category != "permanent":
+                # Ссылки на форматы в кеше могли устареть — извлекаем заново.
+                # Недокачанные .part файлы остаются, yt-dlp продолжит с того же места
+                state["refetch"] = True
+                info = None
+            if retry is not None:
+                raise RetryDownload(delay, state) from e
+            time.sleep(delay)
+
+
+def _make_merge_timer():
+    """postprocessor_hook для yt-dlp: время склейки видео и аудио отдельным этапом"""
+    started = [None]
+
+    def hook(d: dict):
+        if d.get("postprocessor") != "Merger":
+            return
+        if d.get("status") == "started":
+            started[0] = time.monotonic()
+        elif d.get("status") == "finished" and started[0] is not None:
+            metrics.observe("bot_stage_seconds", time.monotonic() - started[0], stage="merge")
+            started[0] = None
+
+    return hook
+
+
+def _download_once(url: str, ydl_opts: dict, info: dict = None) -> str:
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        if info:
+            # Повторно используем метаданные из выбора качества вместо новой экстракции
+            info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        else:
+            info = ydl.extract_info(url, download=True, ie_key=get_ie_key(url))
+        if not info:
+            raise Exception("Не удалось получить информацию о видео")
+
+        filename = ydl.prepare_filename(info)
+        mp4_name = os.path.splitext(filename)[0] + ".mp4"
+
+        # Проверяем, какой файл был создан
+        if os.path.exists(mp4_name):
+            return mp4_name
+        elif os.path.exists(filename):
+            return filename
+
+        # Слишком большой поток yt-dlp не качает и ошибки не выдает — только пишет об этом в лог
+        cap = ydl_opts.get("max_filesize")
+        sizes = [f.get("filesize") or f.get("filesize_approx") for f in info.get("requested_formats") or [info]]
+        too_large = [size for size in sizes if size and cap and size > cap]
+        if too_large:
+            raise Exception(f"Файл больше лимита скачивания: {max(too_large) // (1024 * 1024)} МБ > {cap // (1024 * 1024)} МБ")
+        raise Exception("Файл не был создан")
+
+
+# --- повторы скачивания ---
+# Признаки ошибок в тексте исключений yt-dlp (в нижнем регистре), по приоритету проверки
+_ERROR_PATTERNS = (
+    ("permanent", (
+        "private video", "video unavailable", "is not available", "has been removed",
+        "unsupported url", "больше лимита скачивания", "sign in to confirm",
+        "members-only", "copyright", "http error 404", "http error 410", "geo restricted",
+        "not made this video available",
+    )),
+    ("throttled", ("http error 429", "too many requests", "rate limit", "rate-limit")),
+    ("merge", ("ffmpeg", "postprocessing", "merging", "conversion failed")),
+    ("network", (
+        "timed out", "timeout", "connection", "reset by peer", "temporary failure",
+        "incompleteread", "urlopen error", "http error 5", "http error 403", "unable to download",
+    )),
+)
+_attempt_stats = {}  # {исход: количество}
+
+
+def classify_download_error(error: Exception) -> str:
+    """Тип ошибки скачивания: permanent, throttled, merge, network или unknown"""
+    message = str(error).lower()
+    for category, patterns in _ERROR_PATTERNS:
+        if any(pattern in message for pattern in patterns):
+            return category
+    return "unknown"
+
+
+def _record_attempt(outcome: str):
+    _attempt_stats[outcome] = _attempt_stats.get(outcome, 0) + 1
+
+
+def get_download_attempt_stats() -> dict:
+    """Исходы попыток скачивания (в пуле процессов — только по текущему процессу)"""
+    return dict(_attempt_stats)
+
+
+# --- сохранение состояния ---
+def load_state():
+    """
+    Прогреть память из хранилища при старте: лимиты за сегодня, аналитика,
+    кеш подписок и file_id. Дальше все изменения пишутся в фоне.
+    """
+    storage.init()
+    if config.DOWNLOAD_BACKEND == "queue":
+        jobqueue.init()
+    today = _get_today_date()
+    now = time.time()
+
+    today_day = _get_today_day()
+    for user_id, date, count in storage.load("download_counts", "WHERE date = ?", (today,)):
+        _download_counts.set(user_id, [today_day, count, 0])
+
+    for user_id, first_seen, last_seen, total_downloads, subscribed in storage.load("user_activity"):
+        _analytics["total_downloads"] += total_downloads
+        if subscribed:
+            _analytics["subscribed_users"].add(user_id)
+        _analytics["user_activity"][user_id] = {
+            "first_seen": first_seen,
+            "last_seen": last_seen,
+            "total_downloads": total_downloads,
+            "subscription_status": bool(subscribed),
+        }
+
+    # Загружаем только последние config.ANALYTICS_DAYS дней
+    first_day = _get_date_days_ago(config.ANALYTICS_DAYS - 1)
+    days = {}
+    for date, count in storage.load("daily_downloads", "WHERE date >= ?", (first_day,)):
+        days[date] = [count, 0]
+    for date, count in storage.load("daily_active", "WHERE date >= ?", (first_day,)):
+        days.setdefault(date, [0, 0])[1] = count
+    # Активных за сегодня восстанавливаем поименно, чтобы не считать их повторно
+    today_stats = days.pop(today, [0, 0])
+    _analytics["days"] = OrderedDict(sorted(days.items()))
+    _analytics["days"][today] = [today_stats[0], {
+        user_id for user_id, data in _analytics["user_activity"].items() if data["last_seen"] == today
+    }]
+
+    # Устаревшие записи тоже нужны — как запасной ответ при ошибках API
+    for user_id, channel, is_member, fresh_until in storage.load(
+        "subscriptions", "WHERE fresh_until > ?", (now - config.CHAT_MEMBER_EVENT_TTL,)
+    ):
+        _subscription_cache.set((user_id, channel), (bool(is_member), fresh_until))
+
+    for site, quality, count in storage.load("quality_choices"):
+        _analytics["quality_choices"].setdefault(site, {})[quality] = count
+
+    # В память — только последние FILE_ID_CACHE_SIZE записей; самые свежие кладем последними (LRU)
+    recent = storage.load("file_ids", "ORDER BY rowid DESC LIMIT ?", (config.FILE_ID_CACHE_SIZE,))
+    for media_key, file_id in reversed(recent):
+        _file_id_cache[media_key] = file_id
+
+    logger.info(
+        f"Состояние загружено: пользователей {len(_analytics['user_activity'])}, "
+        f"file_id {len(_file_id_cache)}, подписок в кеше {len(_subscription_cache)}"
+    )
+
+
+# --- клавиатуры ---
+def subscription_keyboard():
+    buttons = [
+        [InlineKeyboardButton(f"🔔 {ch}", url=f"https://t.me/{ch.replace('@','')}")]
+        for ch in config.CHANNELS
+    ]
+    buttons.append([InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")])
+    return InlineKeyboardMarkup(buttons)
+
+
+def _quality_label(url: str, q: int) -> str | None:
+    """Подпись кнопки с оценкой размера; None — скрыть кнопку"""
+    # Добавляем эмодзи в зависимости от качества
+    emoji = "🔥" if q >= 1080 else "⭐" if q >= 720 else "📹"
+    info = get_cached_info(url)
+    size = estimate_quality_size(info, q) if info else None
+    if size is None:
+        return f"{emoji} {q}p"
+    if size > get_size_budget():
+        if config.HIDE_OVERSIZED_QUALITIES:
+            return None
+        # При скачивании будет выбран вариант поменьше, который влезает в лимит
+        return f"⚠️ {q}p ~{size // (1024 * 1024)}МБ"
+    return f"{emoji} {q}p ~{size // (1024 * 1024)}МБ"
+
+
+async def quality_keyboard_async(url: str, user_id: int):
+    """
+    Клавиатура выбора качества. Экстракция форматов идет в пуле потоков с таймаутом —
+    синхронного варианта нет, чтобы она не попала в event loop
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_metadata_executor(), get_available_qualities, url)
+    try:
+        qualities = await asyncio.wait_for(future, timeout=config.METADATA_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Таймаут получения форматов для {url}")
+        qualities = [480, 720, 1080]
+    return _build_quality_keyboard(url, user_id, qualities)
+
+
+def _build_quality_keyboard(url: str, user_id: int, qualities: list[int]):
+    video_id = str(uuid.uuid4())[:8]
+    URL_CACHE[video_id] = url
+
+    # Получаем информацию о лимитах
+    remaining = get_remaining_downloads(user_id, config.MAX_DAILY_DOWNLOADS)
+    
+    # Создаем кнопки в одну строку
+    buttons = []
+    row = []
+    for q in qualities:
+        label = _quality_label(url, q)
+        if label:
+            row.append(InlineKeyboardButton(label, callback_data=f"quality_{q}_{video_id}"))
+    if not row:
+        # Ничего не влезает — оставляем минимальное качество, селектор подберет лучшее возможное
+        q = min(qualities)
+        row.append(InlineKeyboardButton(f"📹 {q}p", callback_data=f"quality_{q}_{video_id}"))
+    buttons.append(row)
+    
+    return InlineKeyboardMarkup(buttons), remaining
+
+
+def pop_cached_url(video_id: str):
+    # Запись не удаляем: после ошибки пользователь может нажать другое качество.
+    # Размер и время жизни ограничены самим кешем
+    return URL_CACHE.get(video_id)
+
+
+def get_cache_stats() -> list[dict]:
+    """Статистика кешей в памяти для администратора"""
+    return [cache.stats() for cache in (URL_CACHE, _subscription_cache, _download_counts, _info_cache, _file_id_cache)]
+
+
+# --- метрики ---
+metrics.describe("bot_cache_hits_total", "counter", "Попадания в кеши")
+metrics.describe("bot_cache_misses_total", "counter", "Промахи кешей")
+metrics.describe("bot_download_attempts_total", "counter", "Попытки скачивания по исходу")
+metrics.describe("bot_cache_entries", "gauge", "Записей в кеше")
+metrics.describe("bot_prefetch_active", "gauge", "Идущие предзагрузки")
+metrics.describe("bot_prefetch_total", "counter", "Предзагрузки по исходу")
+metrics.describe("bot_active_downloads", "gauge", "Выполняемые скачивания")
+metrics.describe("bot_max_concurrent_downloads", "gauge", "Лимит одновременных скачиваний")
+metrics.describe("bot_queue_depth", "gauge", "Скачиваний в очереди")
+metrics.describe("bot_queue_longest_wait_seconds", "gauge", "Ожидание первого в очереди")
+metrics.describe("bot_downloads_dir_bytes", "gauge", "Размер папки скачиваний")
+metrics.describe("bot_disk_free_bytes", "gauge", "Свободное место на диске")
+metrics.describe("bot_admission_load_per_cpu", "gauge", "loadavg за минуту на ядро при последнем замере")
+metrics.describe("bot_admission_mem_available_bytes", "gauge", "MemAvailable при последнем замере")
+metrics.describe("bot_admission_reserved_bytes", "gauge", "Оценка памяти выполняющихся заданий")
+
+
+def _collect_metrics() -> list:
+    load_info = get_system_load()
+    disk = get_disk_stats()
+    samples = [
+        ("bot_active_downloads", {}, load_info["active_downloads"]),
+        ("bot_max_concurrent_downloads", {}, load_info["max_concurrent"]),
+        ("bot_queue_depth", {}, load_info["queue_depth"]),
+        ("bot_queue_longest_wait_seconds", {}, load_info["longest_wait"]),
+        ("bot_downloads_dir_bytes", {}, disk["dir_usage"]),
+        ("bot_disk_free_bytes", {}, disk["free"]),
+    ]
+    for cache_stats in get_cache_stats():
+        samples.append(("bot_cache_hits_total", {"cache": cache_stats["name"]}, cache_stats["hits"]))
+        samples.append(("bot_cache_misses_total", {"cache": cache_stats["name"]}, cache_stats["misses"]))
+        samples.append(("bot_cache_entries", {"cache": cache_stats["name"]}, cache_stats["size"]))
+    for outcome, count in get_download_attempt_stats().items():
+        samples.append(("bot_download_attempts_total", {"outcome": outcome}, count))
+    admission_stats = admission.get_stats()
+    if admission_stats["load"] is not None:
+        samples.append(("bot_admission_load_per_cpu", {}, admission_stats["load"] / admission_stats["cpus"]))
+    if admission_stats["mem_available"] is not None:
+        samples.append(("bot_admission_mem_available_bytes", {}, admission_stats["mem_available"]))
+    samples.append(("bot_admission_reserved_bytes", {}, admission_stats["reserved"]))
+    prefetch_stats = get_prefetch_stats()
+    samples.append(("bot_prefetch_active", {}, prefetch_stats["active"]))
+    for outcome in ("started", "promoted", "cancelled", "preempted"):
+        samples.append(("bot_prefetch_total", {"outcome": outcome}, prefetch_stats[outcome]))
+    return samples
+
+
+metrics.register_collector(_collect_metrics)
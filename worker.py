@@ -0,0 +1,100 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+import config
+import jobqueue
+import progress
+import transcode
+import utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Воркер скачиваний для DOWNLOAD_BACKEND=queue: забирает задания из общей очереди,
+# скачивает и подгоняет видео под лимит, результат пишет обратно в очередь.
+# Один процесс выполняет одно задание за раз — для параллельности запускают несколько
+# на той же машине, что и бот (очередь в SQLite по сети не делится).
+
+
+def _heartbeat_loop(job_id: str, stop: threading.Event):
+    """Отмечаться по заданию и передавать боту текущий прогресс"""
+    while not stop.wait(config.WORKER_HEARTBEAT):
+        try:
+            jobqueue.heartbeat(job_id, progress.get_status(job_id))
+        except Exception as e:
+            logger.warning(f"Не удалось отметиться по заданию {job_id}: {e}")
+
+
+def process_job(job: dict):
+    job_id = job["id"]
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat_loop, args=(job_id, stop), daemon=True)
+    beat.start()
+    file_path = None
+    try:
+        hook = progress.make_download_hook(job_id, job["quality"])
+        file_path = utils.download_video(job["url"], job["quality"], job["info"], hook)
+        if config.ENABLE_TRANSCODE:
+            budget = utils.get_size_budget()
+            if os.path.getsize(file_path) > budget:
+                progress.report(job_id, f"🎞 Сжимаю видео до {budget // (1024 * 1024)} МБ...")
+            file_path = transcode.fit_to_limit(file_path, budget)
+        jobqueue.complete(job_id, file_path)
+        logger.info(f"Задание {job_id} выполнено: {file_path}")
+    except Exception as e:
+        logger.error(f"Задание {job_id} не выполнено: {e}")
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            jobqueue.fail(job_id, str(e))
+        except Exception as e:
+            # Задание без отметок вернет в очередь requeue_stale
+            logger.error(f"Не удалось отметить задание {job_id} как невыполненное: {e}")
+    finally:
+        stop.set()
+        beat.join()
+        progress.finish(job_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер скачиваний (DOWNLOAD_BACKEND=queue)")
+    parser.add_argument("--id", default=f"{socket.gethostname()}:{os.getpid()}", help="имя воркера в очереди")
+    args = parser.parse_args()
+
+    jobqueue.init()
+    os.makedirs(config.DOWNLOADS_DIR, exist_ok=True)
+    print(f"✅ Воркер {args.id} запущен, очередь: {config.JOB_QUEUE_PATH}")
+
+    last_maintenance = 0.0
+    while True:
+        now = time.time()
+        # Обслуживание очереди делает любой воркер — отдельный процесс для этого не нужен
+        if now - last_maintenance > config.JOB_STALE_TIMEOUT:
+            try:
+                requeued = jobqueue.requeue_stale(config.JOB_STALE_TIMEOUT)
+                if requeued:
+                    logger.warning(f"Возвращено в очередь заданий упавших воркеров: {requeued}")
+                jobqueue.purge(config.JOB_RETENTION)
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания очереди: {e}")
+            last_maintenance = now
+
+        # Занятая база (database is locked) не повод останавливать воркер — пробуем позже
+        try:
+            job = jobqueue.claim(args.id)
+        except Exception as e:
+            logger.error(f"Не удалось забрать задание: {e}")
+            time.sleep(config.JOB_POLL_INTERVAL)
+            continue
+        if job is None:
+            time.sleep(config.JOB_POLL_INTERVAL)
+            continue
+        logger.info(f"Задание {job['id']}: {job['url']} ({job['quality']}p)")
+        process_job(job)
+
+
+if __name__ == "__main__":
+    main()